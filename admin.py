@@ -3,6 +3,13 @@ from django.contrib import admin
 from . import models
 
 admin.site.register(models.Event)
+admin.site.register(models.EventSummary)
 admin.site.register(models.Webhook)
 admin.site.register(models.Meeting)
+admin.site.register(models.MonthlyAttendance)
+admin.site.register(models.SeriesAttendance)
+admin.site.register(models.Job)
+admin.site.register(models.AttendeeTally)
+admin.site.register(models.ParticipantReport)
+admin.site.register(models.Registrant)
 
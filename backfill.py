@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+import json
+import os
+
+from django.db import transaction
+import pytz
+
+from zoom import ratelimit
+from zoom import timing
+from zoom import zoom_api as zoom
+from zoom.models import Meeting, save_participants, upsert_meeting
+
+# Archiving past meetings after the fact, from Zoom's reports (see the zoom_backfill command)
+#
+# For meetings whose "meeting ended" webhook never arrived, or whose archiving failed. Zoom is asked
+# concurrently (as background work for the rate limiter), while the database writes happen in the
+# calling thread. Every instance is upserted, so running a backfill again never double-counts.
+
+# Which instances have been archived already, saved to a file so an interrupted backfill can carry on where it left off
+class Checkpoint(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done = set(json.load(f)['done'])
+
+    def mark(self, uuid):
+        self.done.add(uuid)
+
+    def save(self):
+        if not self.path:
+            return
+
+        # write a new file and swap it in, so a crash mid-write can't lose the old one
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'done': sorted(self.done)}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+# What we need to know about a meeting (rather than an instance) to archive its instances
+# The meeting may have been deleted since, in which case we make do without
+def meeting_info(token, meeting_id):
+    try:
+        meeting, _ = zoom.get_meeting(token, meeting_id)
+    except zoom.Error:
+        return {'agenda': '', 'registrants': 0}
+
+    registrants = 0
+    if meeting['settings']['approval_type'] != 2: # registration required
+        try:
+            registrants = len(zoom.get_registrants(token, meeting_id)[0])
+        except zoom.Error:
+            pass
+
+    return {'agenda': meeting.get('agenda', ''), 'registrants': registrants}
+
+# Save what we know about an instance (in one transaction), replacing any earlier record of it, and
+# any error from archiving it live
+# The attendance page and rollups count webhook ('EV') records, so the instance gets one of those too,
+# with the API's numbers, unless it was archived live (the webhooks it was counted from are gone by now)
+def save_instance(instance, info, participants):
+    start = pytz.utc.localize(zoom.parse_time(instance['start_time']))
+    end = pytz.utc.localize(zoom.parse_time(instance['end_time']))
+    fields = {
+            'meeting_id': instance['id'],
+            'title': instance['topic'],
+            'description': info['agenda'],
+            'time': start,
+            'duration': timedelta(minutes=instance['duration']),
+            'registrants': info['registrants'],
+            'participants': len(participants),
+        }
+
+    with transaction.atomic():
+        save_participants(instance['uuid'], instance['id'], participants, start=start)
+        upsert_meeting('API', instance['uuid'], **fields)
+        upsert_meeting('EV', instance['uuid'], replace=False, **fields)
+        Meeting.objects.filter(kind='ERR', meeting_id=instance['id'], time__gte=start, time__lt=end + timedelta(days=1)).delete()
+
+# Archive the meeting instances that took place between two dates (inclusive)
+# Calls progress(instance, error) as each one finishes (error is None on success)
+# Returns the number of instances archived, and the number that failed
+def backfill(start, end, checkpoint, workers=zoom.MAX_CONCURRENCY, progress=None, user='me'):
+    token = zoom.tokens
+    archived = failed = 0
+
+    with ratelimit.background():
+        instances = [instance for instance in zoom.list_past_meetings(token, start, end, user) if instance['uuid'] not in checkpoint.done]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # look up each meeting once, however many instances it has
+            meeting_ids = list(dict.fromkeys(instance['id'] for instance in instances))
+            infos = dict(zip(meeting_ids, pool.map(timing.in_context(lambda meeting_id: meeting_info(token, meeting_id)), meeting_ids)))
+
+            get_participants = timing.in_context(zoom.get_participants)
+            futures = {pool.submit(get_participants, token, instance['uuid']): instance for instance in instances}
+
+            for future in as_completed(futures):
+                instance = futures[future]
+                try:
+                    participants, _ = future.result()
+                    save_instance(instance, infos[instance['id']], participants)
+                except Exception as e:
+                    failed += 1
+                    error = e
+                else:
+                    archived += 1
+                    error = None
+                    checkpoint.mark(instance['uuid'])
+                    if archived % 20 == 0:
+                        checkpoint.save()
+
+                if progress is not None:
+                    progress(instance, error)
+
+    checkpoint.save()
+    return archived, failed
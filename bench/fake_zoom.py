@@ -0,0 +1,190 @@
+# In-process stand-in for api.zoom.us, for benchmarks
+#
+# Serves a configurable account (plain meetings, recurring series, paged registrants and participant
+# reports) from a local HTTP server, with optional latency and rate limiting (429s), and points
+# zoom_api at it for the duration of a `with serve(...)` block.
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+from zoom import zoom_api as zoom
+from zoom.bench.participants import synthetic_report
+
+FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+# The meeting with this ID is in the past, so that its page shows attendance
+PAST_MEETING_ID = 1000
+
+class FakeZoom(object):
+    def __init__(self, meetings=200, series=20, occurrences=5, registrants=1000, participants=5000, past=60, latency=0.02, rate_limit_every=0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        now = datetime.utcnow().replace(microsecond=0)
+        self.meetings = {}
+
+        for i in range(meetings):
+            meeting_id = PAST_MEETING_ID + i
+            start = datetime(2020, 5, 1, 18) if meeting_id == PAST_MEETING_ID else now + timedelta(hours=i + 1)
+            self.meetings[meeting_id] = self.meeting(meeting_id, 2, 'Meeting %d' % i, start)
+
+        for j in range(series):
+            meeting_id = 90000 + j
+            meeting = self.meeting(meeting_id, 8, 'Series %d' % j, now + timedelta(days=1, hours=j))
+            meeting['occurrences'] = [
+                    {'occurrence_id': str(1600000000000 + k), 'start_time': (now + timedelta(days=k + 1, hours=j)).strftime(FMT), 'duration': 60, 'status': 'available'}
+                    for k in range(occurrences)
+                ]
+            self.meetings[meeting_id] = meeting
+
+        self.registrants = [
+                {'id': 'r%d' % i, 'first_name': 'First%d' % i, 'last_name': 'Last%d' % (i * 7919 % registrants),
+                 'email': 'person%d@example.com' % i, 'city': 'Springfield', 'country': 'US',
+                 'custom_questions': [{'title': 'How did you hear about us?', 'value': 'A friend'}]}
+                for i in range(registrants)
+            ]
+        self.participants = synthetic_report(participants, max(1, participants // 10))
+
+        # past instances (for the reports API): one a day, going back from yesterday, cycling through the meetings
+        self.past = []
+        for i in range(past):
+            meeting_id = PAST_MEETING_ID + i % max(1, meetings)
+            start = (now - timedelta(days=i + 1)).replace(hour=18, minute=0, second=0)
+            self.past.append({
+                    'uuid': 'past%d/%d==' % (meeting_id, i), 'id': meeting_id, 'topic': 'Meeting %d' % (meeting_id - PAST_MEETING_ID),
+                    'start_time': start.strftime(FMT), 'end_time': (start + timedelta(minutes=75)).strftime(FMT),
+                    'duration': 75, 'participants_count': len(self.participants),
+                })
+        self.past.reverse()
+
+    def meeting(self, meeting_id, typ, topic, start):
+        return {
+                'id': meeting_id,
+                'uuid': 'uuid%d==' % meeting_id,
+                'type': typ,
+                'topic': topic,
+                'agenda': '',
+                'start_time': start.strftime(FMT),
+                'duration': 60,
+                'timezone': 'UTC',
+                'join_url': 'https://zoom.example/j/%d' % meeting_id,
+                'start_url': 'https://zoom.example/s/%d' % meeting_id,
+                'settings': {'approval_type': 0, 'waiting_room': True, 'mute_upon_entry': False, 'request_permission_to_unmute_participants': False},
+            }
+
+    # The meetings list: one entry per plain meeting, and one per occurrence of each series
+    def meeting_list(self):
+        entries = []
+        for meeting in self.meetings.values():
+            if meeting['id'] == PAST_MEETING_ID:
+                continue
+            if meeting['type'] == 8:
+                for occurrence in meeting['occurrences']:
+                    entries.append(dict(meeting, start_time=occurrence['start_time']))
+            else:
+                entries.append(meeting)
+        return [{k: v for k, v in entry.items() if k not in ('occurrences', 'settings', 'start_url')} for entry in entries]
+
+    # One page of a list, using the offset as the next_page_token
+    def page(self, key, items, query):
+        size = int(query.get('page_size', 30))
+        offset = int(query.get('next_page_token') or 0)
+        return {key: items[offset:offset + size], 'next_page_token': str(offset + size) if offset + size < len(items) else ''}
+
+    # Returns (status, body)
+    def handle(self, method, path, query):
+        with self.lock:
+            self.requests += 1
+            limited = self.rate_limit_every and self.requests % self.rate_limit_every == 0
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            return 429, {'code': 429, 'message': 'You have reached the maximum per-second rate limit for this API.'}
+
+        if re.fullmatch(r'users/[^/]+/meetings', path):
+            if method == 'POST':
+                return 201, dict(self.meetings[PAST_MEETING_ID], id=999999)
+            return 200, self.page('meetings', self.meeting_list(), query)
+
+        match = re.fullmatch(r'meetings/(\d+)', path)
+        if match and int(match.group(1)) in self.meetings:
+            if method == 'PATCH':
+                return 204, None
+            return 200, self.meetings[int(match.group(1))]
+
+        if re.fullmatch(r'meetings/\d+/registrants', path):
+            return 200, self.page('registrants', self.registrants, query)
+
+        if re.fullmatch(r'report/users/[^/]+/meetings', path):
+            past = [p for p in self.past if query['from'] <= p['start_time'][:10] <= query['to']]
+            return 200, self.page('meetings', past, query)
+
+        if re.fullmatch(r'report/meetings/[^/]+/participants', path):
+            return 200, self.page('participants', self.participants, query)
+
+        return 404, {'code': 3001, 'message': 'Meeting does not exist.'}
+
+def handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, like the real thing
+        disable_nagle_algorithm = True # otherwise delayed ACKs add ~40ms to every response
+
+        def respond(self, method):
+            url = urllib.parse.urlsplit(self.path)
+            path = url.path[len('/v2/'):]
+            query = dict(urllib.parse.parse_qsl(url.query))
+
+            if 'Content-Length' in self.headers:
+                self.rfile.read(int(self.headers['Content-Length']))
+
+            status, body = fake.handle(method, path, query)
+            payload = b'' if body is None else json.dumps(body).encode('utf-8')
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json;charset=UTF-8')
+            self.send_header('Content-Length', str(len(payload)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        def do_PATCH(self):
+            self.respond('PATCH')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# Run a fake Zoom API server, and point zoom_api at it, for the duration of the block
+# Yields the FakeZoom instance (see its constructor for the options)
+@contextmanager
+def serve(**options):
+    fake = FakeZoom(**options)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_for(fake))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    api_base = zoom.API_BASE
+    zoom.API_BASE = 'http://127.0.0.1:%d/v2' % server.server_address[1]
+    try:
+        yield fake
+    finally:
+        zoom.API_BASE = api_base
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,61 @@
+# Benchmark for merging participant reports (zoom_api.summarize_participants)
+#
+# Usage: python -m zoom.bench.participants [records] [people]
+#
+# Generates a synthetic report.meetings.participants response with lots of reconnects
+# (including overlapping sessions from several devices) and times both merge engines.
+
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+
+from zoom import zoom_api as zoom
+
+# Make a fake participant report with `records` rows spread over `people` attendees
+def synthetic_report(records=50000, people=5000, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2020, 5, 1, 18, 0, 0)
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+
+    report = []
+    for i in range(records):
+        person = rng.randrange(people)
+        join = start + timedelta(seconds=rng.randrange(3 * 60 * 60))
+        leave = join + timedelta(seconds=rng.randrange(1, 45 * 60))
+        report.append({
+                'name': 'Person %d' % person,
+                'user_email': 'person%d@example.com' % person,
+                'join_time': join.strftime(fmt),
+                'leave_time': leave.strftime(fmt),
+            })
+
+    return report
+
+def time_it(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main(records=50000, people=5000):
+    report = synthetic_report(records, people)
+    print('%d records, %d people' % (records, people))
+
+    elapsed, pure = time_it(lambda: zoom.summarize_participants(report, use_numpy=False))
+    print('  pure python: %8.1f ms (%.0f records/s)' % (elapsed * 1000, records / elapsed))
+
+    if zoom.numpy is None:
+        print('  numpy:       not installed')
+    else:
+        elapsed, vectorized = time_it(lambda: zoom.summarize_participants(report, use_numpy=True))
+        print('  numpy:       %8.1f ms (%.0f records/s)' % (elapsed * 1000, records / elapsed))
+
+        worst = max(abs(pure[email]['duration'] - vectorized[email]['duration']) for email in pure)
+        print('  max difference between engines: %g min' % worst)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
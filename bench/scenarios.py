@@ -0,0 +1,107 @@
+# Benchmark scenarios for the hot paths, run against the fake Zoom API (see fake_zoom.py)
+#
+# The zoom_api scenarios only need the fake server; the view/archive scenarios also need Django
+# and a (test) database, see the zoom_bench management command.
+
+import itertools
+import json
+import time
+
+from zoom import zoom_api as zoom
+from zoom.bench.fake_zoom import PAST_MEETING_ID
+
+class Result(object):
+    def __init__(self, name, latencies, wall):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.wall = wall
+
+    def percentile(self, p):
+        return self.latencies[min(len(self.latencies) - 1, int(p / 100 * len(self.latencies)))]
+
+    def line(self):
+        return '%-36s %6d runs %8.1f/s   p50 %8.1f ms   p90 %8.1f ms   p99 %8.1f ms   max %8.1f ms' % (
+                self.name, len(self.latencies), len(self.latencies) / self.wall,
+                self.percentile(50) * 1000, self.percentile(90) * 1000, self.percentile(99) * 1000, self.latencies[-1] * 1000)
+
+# Time `fn` over `iterations` runs, calling `setup` (untimed) before each one
+def measure(name, fn, iterations, setup=None):
+    latencies = []
+    wall = 0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        latencies.append(elapsed)
+        wall += elapsed
+    return Result(name, latencies, wall)
+
+def api_scenarios(iterations):
+    token = zoom.tokens
+    return [
+            measure('zoom_api.list_meetings', lambda: zoom.list_meetings(token), iterations),
+            measure('zoom_api.get_meeting', lambda: zoom.get_meeting(token, PAST_MEETING_ID), iterations),
+            measure('zoom_api.get_registrants', lambda: zoom.get_registrants(token, PAST_MEETING_ID), iterations),
+            measure('zoom_api.get_participants', lambda: zoom.get_participants(token, PAST_MEETING_ID), iterations),
+        ]
+
+# Needs Django set up with a database to write to, and a logged in test client
+def django_scenarios(client, iterations, webhook_token=''):
+    from django.urls import reverse
+
+    from zoom import caching
+    from zoom import payloads
+    from zoom.models import Meeting, ParticipantReport, RegistrantSync, Webhook, archive_meeting_data
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, '%s returned %d' % (url, response.status_code)
+
+    meetings_url = reverse('meetings')
+    past_url = reverse('meeting', kwargs={'meeting_id': PAST_MEETING_ID})
+    upcoming_url = reverse('meeting', kwargs={'meeting_id': PAST_MEETING_ID + 1})
+    rows_url = reverse('meeting_rows', kwargs={'meeting_id': PAST_MEETING_ID}) + '?uuid=uuid%d==' % PAST_MEETING_ID
+
+    def forget_meeting():
+        ParticipantReport.objects.filter(meeting_id=PAST_MEETING_ID).delete()
+        RegistrantSync.objects.filter(meeting_id=PAST_MEETING_ID).delete()
+
+    counter = itertools.count()
+
+    def webhook_body(event, obj):
+        return json.dumps({'event': event, 'event_ts': int(time.time() * 1000) + next(counter), 'payload': {'object': obj}})
+
+    def post_webhook():
+        n = next(counter)
+        body = webhook_body('meeting.participant_joined_waiting_room', {
+                'id': PAST_MEETING_ID, 'uuid': 'uuid%d==' % PAST_MEETING_ID,
+                'participant': {'user_id': str(n), 'user_name': 'Person %d' % n}})
+        response = client.post(reverse('webhook'), body, content_type='application/json', HTTP_AUTHORIZATION=webhook_token)
+        assert response.status_code == 200, 'webhook returned %d' % response.status_code
+
+    # a meeting that just ended, with a few hundred unique attendees' join events waiting to be counted
+    archive_event = {}
+
+    def prepare_archive():
+        Webhook.objects.filter(meeting_id=PAST_MEETING_ID).delete()
+        Meeting.objects.filter(meeting_id=PAST_MEETING_ID).delete()
+        Webhook.objects.bulk_create([
+                Webhook(event='JWR', meeting_id=PAST_MEETING_ID, attendee='Person %d' % (i % 300), data='{}')
+                for i in range(1000)
+            ])
+        archive_event['hook'] = Webhook.objects.create(event='ME', meeting_id=PAST_MEETING_ID, payload=payloads.pack(json.loads(webhook_body('meeting.ended', {
+                'id': PAST_MEETING_ID, 'uuid': 'uuid%d==' % PAST_MEETING_ID,
+                'start_time': '2020-05-01T18:00:00Z', 'end_time': '2020-05-01T19:00:00Z'}))))
+
+    return [
+            measure('views.meetings (cold)', lambda: get(meetings_url), iterations, setup=caching.invalidate_meetings),
+            measure('views.meetings (cached)', lambda: get(meetings_url), iterations),
+            measure('views.meeting (upcoming)', lambda: get(upcoming_url), iterations),
+            measure('views.meeting (past, cold)', lambda: get(past_url), iterations, setup=forget_meeting),
+            measure('views.meeting (past, warm)', lambda: get(past_url), iterations),
+            measure('views.meeting_rows (first page)', lambda: get(rows_url), iterations),
+            measure('views.webhook (join)', post_webhook, iterations),
+            measure('archive_meeting', lambda: archive_meeting_data(archive_event['hook']), iterations, setup=prepare_archive),
+        ]
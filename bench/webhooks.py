@@ -0,0 +1,122 @@
+# Benchmark for webhook ingest: parsing the notification and encoding it for storage
+#
+# Usage: python -m zoom.bench.webhooks [notifications]
+#
+# Generates realistic join/registration notifications and compares the old way of storing them (the
+# body as text, plus a str() of the participant/registrant) with the reduced payload (and the deflated
+# whole body that came in between), and the standard json module with orjson (if it's installed).
+
+import gc
+import json
+import random
+import sys
+import time
+
+from zoom import payloads
+from zoom import zoom_api as zoom
+
+# Make `count` fake notifications (as request bodies), mostly waiting room joins with some registrations
+def synthetic_notifications(count=10000, seed=0):
+    rng = random.Random(seed)
+    bodies = []
+
+    for i in range(count):
+        person = rng.randrange(100000)
+        obj = {
+                'uuid': '%022x==' % rng.getrandbits(88),
+                'id': str(80000000000 + rng.randrange(1000)),
+                'host_id': 'z8yAAAAA8bbbQ',
+                'topic': 'Weekly Talk %d' % rng.randrange(50),
+                'type': rng.choice((2, 8)),
+                'start_time': '2020-05-03T14:00:00Z',
+                'duration': 90,
+                'timezone': 'America/Los_Angeles',
+            }
+
+        if rng.random() < 0.8:
+            event = 'meeting.participant_joined_waiting_room'
+            obj['participant'] = {'user_id': str(16778240 + person), 'user_name': 'Person %d' % person, 'id': '', 'join_time': '2020-05-03T14:%02d:%02dZ' % (rng.randrange(60), rng.randrange(60))}
+        else:
+            event = 'meeting.registration_created'
+            obj['registrant'] = {
+                    'id': '%010x' % rng.getrandbits(40), 'first_name': 'Person', 'last_name': str(person), 'email': 'person%d@example.com' % person,
+                    'address': '', 'city': 'Springfield', 'country': 'US', 'zip': '', 'state': 'OR', 'phone': '', 'industry': '', 'org': '',
+                    'job_title': '', 'purchasing_time_frame': '', 'role_in_purchase_process': '', 'no_of_employees': '', 'comments': '',
+                    'custom_questions': [{'title': 'How did you hear about us?', 'value': 'A friend'}],
+                    'status': 'approved', 'join_url': 'https://zoom.us/w/%s?tk=%016x' % (obj['id'], rng.getrandbits(64)),
+                }
+
+        body = {'event': event, 'payload': {'account_id': 'AbCdEfGhIjKlMnOp', 'object': obj}, 'event_ts': 1588514531000 + i}
+        bodies.append(json.dumps(body, separators=(',', ':')).encode('utf-8'))
+
+    return bodies
+
+# Best of `repeat` runs (with the garbage collector off, like timeit, so that collections triggered by
+# the results piling up don't land on whichever run happens to be going)
+def time_it(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main(count=10000):
+    bodies = synthetic_notifications(count)
+    print('%d notifications' % count)
+
+    def legacy_size(body):
+        obj = json.loads(body)['payload']['object']
+        return len(body) + len(str(obj.get('participant') or obj.get('registrant')))
+
+    legacy = sum(map(legacy_size, bodies))
+    compressed = sum(len(payloads.compress(body)) for body in bodies)
+    reduced = sum(len(payloads.pack(json.loads(body))) for body in bodies)
+    print('  stored bytes:  text + str() %8.0f/row   compressed %8.0f/row   reduced %8.0f/row  (%.0f%% smaller)' % (legacy / count, compressed / count, reduced / count, 100 * (1 - reduced / legacy)))
+
+    elapsed, _ = time_it(lambda: [json.loads(body) for body in bodies])
+    print('  parse (json):   %8.1f us/notification' % (elapsed / count * 1e6))
+
+    if zoom.orjson is None:
+        print('  parse (orjson): not installed')
+    else:
+        elapsed, _ = time_it(lambda: [zoom.orjson.loads(body) for body in bodies])
+        print('  parse (orjson): %8.1f us/notification' % (elapsed / count * 1e6))
+
+    elapsed, blobs = time_it(lambda: [payloads.compress(body) for body in bodies])
+    print('  compress:       %8.1f us/notification' % (elapsed / count * 1e6))
+
+    elapsed, _ = time_it(lambda: [payloads.decompress(blob) for blob in blobs])
+    print('  decompress:     %8.1f us/notification' % (elapsed / count * 1e6))
+
+    parsed = [json.loads(body) for body in bodies]
+    elapsed, _ = time_it(lambda: [payloads.pack(data) for data in parsed])
+    print('  pack:           %8.1f us/notification' % (elapsed / count * 1e6))
+
+    # everything the webhook view does to a notification before inserting it, returning what's stored
+    # (the insert itself is timed by the zoom_bench command, as views.webhook)
+    def legacy_ingest(body):
+        obj = json.loads(body)['payload']['object']
+        return body.decode('utf-8'), str(obj.get('participant') or obj.get('registrant'))
+
+    def compressed_ingest(body):
+        zoom.json_loads(body)
+        return payloads.compress(body)
+
+    def ingest(body):
+        return payloads.pack(zoom.json_loads(body))
+
+    elapsed, _ = time_it(lambda: [legacy_ingest(body) for body in bodies])
+    print('  ingest (text):      %8.1f us/notification' % (elapsed / count * 1e6))
+    elapsed, _ = time_it(lambda: [compressed_ingest(body) for body in bodies])
+    print('  ingest (deflated):  %8.1f us/notification' % (elapsed / count * 1e6))
+    elapsed, _ = time_it(lambda: [ingest(body) for body in bodies])
+    print('  ingest (now):       %8.1f us/notification' % (elapsed / count * 1e6))
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
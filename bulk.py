@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from zoom import ratelimit
+from zoom import timing
+from zoom import zoom_api as zoom
+from zoom.models import Event
+
+# Applying a settings policy to many meetings at once (see the zoom_bulk_settings command and the
+# bulk_settings view)
+#
+# Meetings are picked from the meeting list, and the PATCHes are made concurrently, as
+# background work for the rate limiter, so a big batch can't crowd out page views.
+
+class BulkResult(object):
+    def __init__(self, meeting, code, error=''):
+        self.meeting = meeting
+        self.code = code
+        self.error = error
+
+    @property
+    def ok(self):
+        return 200 <= self.code < 300
+
+# Pick meetings from a meeting list
+#   - topic: only meetings whose topic contains this (case insensitive)
+#   - start/end: only meetings starting in this range (datetimes, either can be None)
+#   - meeting_ids: only these meetings
+# A recurring series is only returned once (at its first matching occurrence), since its settings are
+# shared by every occurrence
+def select_meetings(meetings, topic=None, start=None, end=None, meeting_ids=None):
+    selected = {}
+    for m in meetings:
+        if m['id'] in selected:
+            continue
+        if meeting_ids and m['id'] not in meeting_ids:
+            continue
+        if topic and topic.lower() not in m['topic'].lower():
+            continue
+        if start is not None or end is not None:
+            time = m.start.replace(tzinfo=None) # naive UTC, like start and end
+            if start is not None and time < start:
+                continue
+            if end is not None and time >= end:
+                continue
+        selected[m['id']] = m
+    return list(selected.values())
+
+# Turn {setting name: value} into the body of an update_meeting request
+# Only zoom_api.EDITABLE_SETTINGS can be set
+def settings_updates(values):
+    editable = {setting[0] for setting in zoom.EDITABLE_SETTINGS}
+    unknown = set(values) - editable
+    if unknown:
+        raise ValueError('Not an editable setting: %s' % ', '.join(sorted(unknown)))
+    return {'settings': dict(values)}
+
+# Apply the same updates to every meeting, at most `concurrency` requests at a time
+# Writes one audit Event per meeting (as `user`), then returns a BulkResult per meeting, in order
+def apply_updates(user, meetings, updates, concurrency=zoom.MAX_CONCURRENCY):
+    if not meetings:
+        return []
+
+    data = json.dumps(updates)
+    Event.objects.bulk_create([Event(user=user, event='UP', meeting_id=m['id'], data=data) for m in meetings])
+
+    token = zoom.tokens
+
+    def update(m):
+        try:
+            _, code = zoom.update_meeting(token, m['id'], updates)
+        except zoom.Error as e:
+            return BulkResult(m, e.code, e.data.get('message', json.dumps(e.data)))
+        return BulkResult(m, code)
+
+    with ratelimit.background():
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(meetings)))) as pool:
+            return list(pool.map(timing.in_context(update), meetings))
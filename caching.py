@@ -0,0 +1,78 @@
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from zoom import secrets
+from zoom import zoom_api as zoom
+
+# Only needed for the async views (it requires httpx)
+try:
+    from zoom import zoom_api_async
+except ImportError:
+    zoom_api_async = None
+
+# How long (in seconds) a cached meeting list is used, even if nothing invalidates it
+MEETINGS_TTL = getattr(secrets, 'MEETINGS_CACHE_TTL', 300)
+
+# Only cache the list types Zoom actually accepts (they also make safe cache keys)
+MEETING_LIST_TYPES = ('scheduled', 'live', 'upcoming', 'upcoming_meetings', 'previous_meetings')
+
+# How long (in seconds) a rendered page fragment is kept (they're keyed on the data they show, so this
+# only limits how long ones that are out of date hang around)
+FRAGMENT_TTL = getattr(secrets, 'FRAGMENT_CACHE_TTL', 60 * 60)
+
+MEETINGS_VERSION_KEY = 'zoom:meetings:version'
+
+# Every cached meeting list is keyed on a version number, so invalidating all of them
+# (for every user and list type) is a single increment
+def meetings_version():
+    version = cache.get(MEETINGS_VERSION_KEY)
+    if version is None:
+        # start from the current time rather than 1, so that if the version key gets evicted
+        # we can't accidentally resurrect lists cached under an old version
+        cache.add(MEETINGS_VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(MEETINGS_VERSION_KEY)
+    return version
+
+# Drop all cached meeting lists
+# Call this whenever a meeting is created/changed, here or on Zoom's side
+def invalidate_meetings():
+    try:
+        cache.incr(MEETINGS_VERSION_KEY)
+    except ValueError:
+        # key doesn't exist (yet, or any more), so there's nothing cached under it
+        cache.add(MEETINGS_VERSION_KEY, int(time.time() * 1000), None)
+
+# The cache key for a user's list of meetings (of type `typ`), or None if that type isn't cached
+# (it changes whenever the list is invalidated, so it also works for caching things made from the list)
+def meetings_key(user, typ):
+    if typ not in MEETING_LIST_TYPES:
+        return None
+    return 'zoom:meetings:%s:%s:%s' % (meetings_version(), user, typ)
+
+# Cached version of zoom_api.list_meetings
+def list_meetings(token, user='me', typ='upcoming'):
+    key = meetings_key(user, typ)
+    if key is None:
+        return zoom.list_meetings(token, user=user, typ=typ)
+
+    result = cache.get(key)
+    if result is None:
+        result = zoom.list_meetings(token, user=user, typ=typ)
+        cache.set(key, result, MEETINGS_TTL)
+
+    return result
+
+# Async version of list_meetings, for the async views
+async def alist_meetings(token, user='me', typ='upcoming'):
+    key = await sync_to_async(meetings_key)(user, typ)
+    if key is None:
+        return await zoom_api_async.list_meetings(token, user=user, typ=typ)
+
+    result = await sync_to_async(cache.get)(key)
+    if result is None:
+        result = await zoom_api_async.list_meetings(token, user=user, typ=typ)
+        await sync_to_async(cache.set)(key, result, MEETINGS_TTL)
+
+    return result
@@ -0,0 +1,105 @@
+from datetime import timedelta
+import time
+import traceback
+
+from django.db.models import F
+from django.utils import timezone
+
+from zoom import ratelimit
+from zoom import secrets
+from zoom.models import Job, archive_meeting_data, archive_error
+
+# A failing job is retried this many times in total, waiting RETRY_DELAY seconds before the
+# first retry and doubling the wait each time after that
+MAX_ATTEMPTS = getattr(secrets, 'JOB_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(secrets, 'JOB_RETRY_DELAY', 60)
+
+# A job that has been "running" for longer than this is assumed to belong to a dead worker
+STALE_AFTER = getattr(secrets, 'JOB_STALE_AFTER', 60 * 60)
+
+# How often (seconds) a running worker checks for jobs like that
+REQUEUE_INTERVAL = STALE_AFTER / 4
+
+def run_archive(job):
+    # the webhook can only be gone if somebody deleted it while the job was waiting
+    if job.webhook is not None:
+        archive_meeting_data(job.webhook)
+
+def fail_archive(job):
+    if job.webhook is not None:
+        archive_error(int(job.webhook.meeting_id), job.error)
+
+# task type -> (handler, called once the job has failed for the last time)
+HANDLERS = {
+        'AR': (run_archive, fail_archive),
+    }
+
+# Atomically take the next runnable job, so that several workers can share the queue
+# Returns None if there's nothing to do
+def claim():
+    now = timezone.now()
+    candidates = Job.objects.filter(status='P', run_after__lte=now).order_by('run_after', 'id').values_list('id', flat=True)[:10]
+
+    for pk in candidates:
+        # only one worker can win this update
+        if Job.objects.filter(pk=pk, status='P').update(status='R', started=now, attempts=F('attempts') + 1) == 1:
+            return Job.objects.select_related('webhook').get(pk=pk)
+
+    return None
+
+def run_job(job):
+    run, fail = HANDLERS[job.task]
+
+    try:
+        # background work, so it mustn't crowd out page views' Zoom API calls
+        # (no transaction around the whole job: handlers make their writes in one once they're done with Zoom)
+        with ratelimit.background():
+            run(job)
+    except Exception:
+        print(traceback.format_exc())
+        job.error = traceback.format_exc()
+
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = 'F'
+            fail(job)
+        else:
+            job.status = 'P'
+            job.run_after = timezone.now() + timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        job.save()
+    else:
+        # nothing worth keeping about a job that worked
+        job.delete()
+
+# Run jobs until there are none left that are due
+# Returns the number of jobs that were run
+def run_pending():
+    count = 0
+    while True:
+        job = claim()
+        if job is None:
+            return count
+
+        run_job(job)
+        count += 1
+
+# Put jobs left "running" by a worker that died back in the queue
+def requeue_stale():
+    return Job.objects.filter(status='R', started__lt=timezone.now() - timedelta(seconds=STALE_AFTER)).update(status='P')
+
+# The state of a worker process's loop (see the zoom_worker command)
+# Stale jobs are looked for when it starts and every REQUEUE_INTERVAL seconds after that, since a job
+# abandoned by a worker that was restarted straight away won't be stale yet when the new one starts
+class Worker(object):
+    def __init__(self):
+        self.last_requeue = None
+
+    # Requeue stale jobs (if it's time to look), then run whatever is due
+    # Returns the number of jobs requeued and the number run
+    def poll(self):
+        requeued = 0
+        now = time.monotonic()
+        if self.last_requeue is None or now - self.last_requeue >= REQUEUE_INTERVAL:
+            requeued = requeue_stale()
+            self.last_requeue = now
+
+        return requeued, run_pending()
@@ -0,0 +1,40 @@
+from datetime import date, datetime, timedelta
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from zoom import backfill
+from zoom import zoom_api as zoom
+
+def parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+class Command(BaseCommand):
+    help = "Archives attendance for past meetings from Zoom's reports (e.g. ones whose webhooks were missed, or whose archiving failed)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=parse_date, required=True, metavar='YYYY-MM-DD', help='First day to archive')
+        parser.add_argument('--to', dest='end', type=parse_date, default=date.today() - timedelta(days=1), metavar='YYYY-MM-DD', help='Last day to archive (default: yesterday)')
+        parser.add_argument('--user', default='me', help='Whose meetings to archive')
+        parser.add_argument('--workers', type=int, default=zoom.MAX_CONCURRENCY, help='Maximum number of requests to Zoom at once')
+        parser.add_argument('--checkpoint', help='File to record progress in, so that an interrupted backfill can be resumed (default: one per date range, in the temp directory)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the progress recorded by an earlier run, and archive everything again')
+
+    def handle(self, *args, **options):
+        path = options['checkpoint'] or os.path.join(tempfile.gettempdir(), 'zoom-backfill-%s-%s-%s.json' % (options['user'], options['start'], options['end']))
+        if options['restart'] and os.path.exists(path):
+            os.remove(path)
+
+        checkpoint = backfill.Checkpoint(path)
+        if checkpoint.done:
+            self.stdout.write('Resuming: %d instances were archived already (see %s)' % (len(checkpoint.done), path))
+
+        def progress(instance, error):
+            if error is None:
+                self.stdout.write('%s  %s  %s' % (instance['start_time'], instance['id'], instance['topic']))
+            else:
+                self.stderr.write('%s  %s  %s  failed: %s' % (instance['start_time'], instance['id'], instance['topic'], getattr(error, 'data', error)))
+
+        archived, failed = backfill.backfill(options['start'], options['end'], checkpoint, options['workers'], progress, options['user'])
+        self.stdout.write('Archived %d meeting instances, %d failed%s' % (archived, failed, ' (run this again to retry them)' if failed else ''))
@@ -0,0 +1,66 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from unittest import mock
+
+from zoom import ratelimit
+from zoom import secrets
+from zoom import zoom_api as zoom
+from zoom.bench import fake_zoom, scenarios
+
+# Stand-in credentials, so the benchmark never signs requests with (or needs) the real ones
+BENCH_SECRETS = {
+    'JWT_API_KEY': 'bench-key',
+    'JWT_SECRET': 'bench-secret-bench-secret-bench-secret',
+    'WEBHOOK_VERIFICATION_TOKEN': 'bench-webhook-token',
+}
+
+class Command(BaseCommand):
+    help = 'Benchmarks the Zoom API client, views and archiving against a local fake Zoom API (uses a throwaway test database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Runs per scenario')
+        parser.add_argument('--latency', type=float, default=20, help='Simulated Zoom API latency per request, in ms')
+        parser.add_argument('--rate-limit-every', type=int, default=0, help='Answer every Nth API request with a 429')
+        parser.add_argument('--meetings', type=int, default=200, help='Number of (non-recurring) meetings')
+        parser.add_argument('--series', type=int, default=20, help='Number of recurring meeting series')
+        parser.add_argument('--occurrences', type=int, default=5, help='Occurrences per recurring series')
+        parser.add_argument('--registrants', type=int, default=1000, help='Registrants per meeting')
+        parser.add_argument('--participants', type=int, default=5000, help='Participant report records per meeting')
+        parser.add_argument('--rate-limiter', action='store_true', help="Keep the Zoom API rate limiter on (it's off by default, since it would mostly measure the limits)")
+        parser.add_argument('--api-only', action='store_true', help="Only benchmark zoom_api (doesn't touch the database)")
+
+    def handle(self, *args, **options):
+        fake_options = {k: options[k] for k in ('meetings', 'series', 'occurrences', 'registrants', 'participants')}
+        fake_options['latency'] = options['latency'] / 1000
+        fake_options['rate_limit_every'] = options['rate_limit_every']
+
+        ratelimit.ENABLED = options['rate_limiter']
+
+        with mock.patch.multiple(secrets, create=True, **BENCH_SECRETS), \
+                mock.patch.object(zoom, 'tokens', zoom.TokenCache()), \
+                fake_zoom.serve(**fake_options) as fake:
+            results = scenarios.api_scenarios(options['iterations'])
+            if not options['api_only']:
+                results += self.django_scenarios(options['iterations'])
+
+            for result in results:
+                self.stdout.write(result.line())
+            self.stdout.write('%d requests to the fake Zoom API' % fake.requests)
+
+    def django_scenarios(self, iterations):
+        # use a separate database and cache, so the benchmark can't touch real data
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'zoom-bench'}}):
+                user = User.objects.create_user('bench', is_staff=True)
+                client = Client()
+                client.force_login(user)
+
+                return scenarios.django_scenarios(client, iterations, BENCH_SECRETS['WEBHOOK_VERIFICATION_TOKEN'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
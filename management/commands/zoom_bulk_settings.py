@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from zoom import bulk
+from zoom import ratelimit
+from zoom import zoom_api as zoom
+
+def parse_setting(text):
+    name, _, value = text.partition('=')
+    if value.lower() not in ('true', 'false', 'on', 'off', '1', '0'):
+        raise ValueError(text)
+    return name, value.lower() in ('true', 'on', '1')
+
+def parse_date(text):
+    return datetime.strptime(text, '%Y-%m-%d')
+
+class Command(BaseCommand):
+    help = 'Changes settings (e.g. waiting room) on every meeting that matches the filters'
+
+    def add_arguments(self, parser):
+        names = ', '.join(setting[0] for setting in zoom.EDITABLE_SETTINGS)
+        parser.add_argument('--set', dest='settings', action='append', type=parse_setting, required=True, metavar='SETTING=true|false', help='Setting to change (can be repeated): %s' % names)
+        parser.add_argument('--user', required=True, help='Username to record the changes under')
+        parser.add_argument('--type', default='upcoming', help='Which meeting list to select from (e.g. upcoming, scheduled)')
+        parser.add_argument('--topic', help='Only meetings whose topic contains this')
+        parser.add_argument('--from', dest='start', type=parse_date, metavar='YYYY-MM-DD', help='Only meetings starting on or after this date (UTC)')
+        parser.add_argument('--to', dest='end', type=parse_date, metavar='YYYY-MM-DD', help='Only meetings starting before this date (UTC)')
+        parser.add_argument('--meeting', dest='meeting_ids', action='append', type=int, help='Only this meeting (can be repeated)')
+        parser.add_argument('--concurrency', type=int, default=zoom.MAX_CONCURRENCY, help='Maximum number of requests to Zoom at once')
+        parser.add_argument('--dry-run', action='store_true', help="List the meetings that would be changed, but don't change them")
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError('No such user: %s' % options['user'])
+
+        try:
+            updates = bulk.settings_updates(dict(options['settings']))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        with ratelimit.background():
+            meetings, _ = zoom.list_meetings(zoom.tokens, typ=options['type'], follow_recurring=False)
+        meetings = bulk.select_meetings(meetings, options['topic'], options['start'], options['end'], options['meeting_ids'])
+
+        if options['dry_run']:
+            for m in meetings:
+                self.stdout.write('%s  %s  %s' % (m['id'], m['start_time'], m['topic']))
+            self.stdout.write('%d meetings would be changed' % len(meetings))
+            return
+
+        results = bulk.apply_updates(user, meetings, updates, options['concurrency'])
+        for result in results:
+            status = 'ok' if result.ok else 'failed (%d): %s' % (result.code, result.error)
+            self.stdout.write('%s  %s  %s' % (result.meeting['id'], result.meeting['topic'], status))
+
+        failed = sum(1 for result in results if not result.ok)
+        self.stdout.write('%d meetings changed, %d failed' % (len(results) - failed, failed))
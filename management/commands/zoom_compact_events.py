@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from zoom import secrets
+from zoom.models import compact_events
+
+# How long (days) audit events are kept individually before they're folded into per-meeting summaries
+EVENT_RETENTION_DAYS = getattr(secrets, 'EVENT_RETENTION_DAYS', 365)
+
+class Command(BaseCommand):
+    help = 'Compacts old audit events (start clicks, edits) into per-meeting, per-person summaries (run it periodically, e.g. daily from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=EVENT_RETENTION_DAYS, help='Keep events from the last this many days as they are')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Events to compact per transaction')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        compacted = compact_events(cutoff, options['batch_size'])
+        self.stdout.write('Compacted %d event%s from before %s' % (compacted, '' if compacted == 1 else 's', cutoff.date()))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Length, Substr
+
+from zoom.models import Meeting, MonthlyAttendance, SeriesAttendance, rebuild_rollups
+
+EVENTS_SUFFIX = ' (from events)'
+
+class Command(BaseCommand):
+    help = 'Recomputes the attendance totals (per month and per meeting), first converting records from before meetings had a kind'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # records used to be told apart by their titles
+            legacy = Meeting.objects.filter(kind='API')
+            events = legacy.filter(title__endswith=EVENTS_SUFFIX).update(
+                    kind='EV', title=Substr('title', 1, Length('title') - len(EVENTS_SUFFIX)))
+            errors = legacy.filter(title__startswith='Error cleaning up ').update(kind='ERR')
+            if events or errors:
+                self.stdout.write('Converted %d event records and %d errors' % (events, errors))
+
+            rebuild_rollups()
+
+        self.stdout.write('%d months, %d meetings/series' % (MonthlyAttendance.objects.count(), SeriesAttendance.objects.count()))
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from zoom import ratelimit
+from zoom import timing
+from zoom import zoom_api as zoom
+from zoom.models import sync_registrants
+
+class Command(BaseCommand):
+    help = 'Refreshes the local copy of registrants for upcoming meetings (run it periodically, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('meeting_ids', nargs='*', type=int, help='Meetings to sync (default: all upcoming meetings)')
+
+    def handle(self, *args, **options):
+        with ratelimit.background():
+            self.sync(options['meeting_ids'])
+
+    def sync(self, meeting_ids):
+        token = zoom.tokens
+
+        if not meeting_ids:
+            meetings, _ = zoom.list_meetings(token, follow_recurring=False)
+            meeting_ids = list(dict.fromkeys(m['id'] for m in meetings))
+
+        def fetch(meeting_id):
+            try:
+                return zoom.get_registrants(token, meeting_id)[0]
+            except zoom.Error:
+                # most likely registration isn't enabled for this meeting
+                return None
+
+        # fetch from Zoom concurrently (in_context keeps the background priority), but do the database writes here
+        with ThreadPoolExecutor(max_workers=zoom.MAX_CONCURRENCY) as pool:
+            for meeting_id, registrants in zip(meeting_ids, pool.map(timing.in_context(fetch), meeting_ids)):
+                if registrants is None:
+                    continue
+
+                added, changed, removed = sync_registrants(meeting_id, registrants)
+                self.stdout.write('%s: %d registrants (%d added, %d changed, %d removed)' % (meeting_id, len(registrants), added, changed, removed))
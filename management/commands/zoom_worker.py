@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from zoom import jobs
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (e.g. archiving attendance after a meeting ends)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run whatever is due, then exit instead of waiting for more')
+        parser.add_argument('--poll', type=float, default=5, help='Seconds to wait between checks for new jobs')
+
+    def handle(self, *args, **options):
+        worker = jobs.Worker()
+
+        while True:
+            # this process lives for a long time, so don't hang on to dead connections
+            close_old_connections()
+
+            requeued, count = worker.poll()
+            if requeued:
+                self.stdout.write('Requeued %d stale job%s' % (requeued, 's' if requeued != 1 else ''))
+            if count:
+                self.stdout.write('Ran %d job%s' % (count, 's' if count != 1 else ''))
+
+            if options['once']:
+                break
+            if count == 0:
+                time.sleep(options['poll'])
@@ -1,15 +1,31 @@
-import ast
 from datetime import datetime, timedelta
+import hashlib
 import pytz
 import json
 import traceback
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth import models as auth_models
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from zoom import zoom_api as zoom
+from zoom import caching
+from zoom import payloads
+from zoom import secrets
+from zoom.sketch import HyperLogLog
+
+# How to count unique attendees while a meeting is running:
+#   - None: store a Webhook row per join/registration and count them when the meeting ends
+#   - 'exact': keep a running set of (hashed) attendee keys per meeting instance
+#   - 'approx': keep a running HyperLogLog sketch per meeting instance (constant size, ~1.6% error)
+ATTENDEE_COUNTER = getattr(secrets, 'ATTENDEE_COUNTER', None)
+ATTENDEE_SKETCH_PRECISION = getattr(secrets, 'ATTENDEE_SKETCH_PRECISION', 12)
+
+# Store the full Webhook row for joins/registrations even when they're being counted as they arrive
+WEBHOOK_DEBUG = getattr(secrets, 'WEBHOOK_DEBUG', False)
 
 class Event(models.Model):
     EVENT_TYPES = [
@@ -24,10 +40,69 @@ class Event(models.Model):
     meeting_id = models.BigIntegerField()
     data = models.TextField(default='', blank=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['meeting_id', 'event', 'timestamp'])]
+
     def __str__(self):
         verbs = {'ST': 'started', 'UP': 'edited', 'CR': 'created'}
         return '[%s] %s (%s) %s %s' % (self.timestamp.astimezone().strftime('%c %Z'), self.user, ' '.join([self.user.first_name, self.user.last_name]), verbs[self.event], self.meeting_id)
 
+# What's left of old Events once they've been compacted (see compact_events): how many times each
+# person did each thing to each meeting, and when they first/last did it
+class EventSummary(models.Model):
+    meeting_id = models.BigIntegerField()
+    event = models.CharField(max_length=2, choices=Event.EVENT_TYPES)
+    user = models.ForeignKey(auth_models.User, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    first = models.DateTimeField()
+    last = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('meeting_id', 'event', 'user')]
+
+    def __str__(self):
+        return '%s %s %s: %d times (%s to %s)' % (self.user, self.get_event_display(), self.meeting_id, self.count, self.first.date(), self.last.date())
+
+# Everyone who has started a meeting through this app (each once, however many times they clicked)
+def meeting_starters(meeting_id):
+    return auth_models.User.objects.filter(
+            models.Q(pk__in=Event.objects.filter(meeting_id=meeting_id, event='ST').values('user_id')) |
+            models.Q(pk__in=EventSummary.objects.filter(meeting_id=meeting_id, event='ST').values('user_id')))
+
+# Fold Events from before `cutoff` into EventSummary rows, `batch_size` at a time (each batch in its own
+# transaction, so this can run alongside the site without holding locks for long)
+# Returns the number of Events compacted
+def compact_events(cutoff, batch_size=1000):
+    compacted = 0
+
+    while True:
+        with transaction.atomic():
+            # oldest first, which is also primary key order, so each batch is a short walk along the primary key
+            batch = list(Event.objects.filter(timestamp__lt=cutoff).order_by('id').values_list('id', 'meeting_id', 'event', 'user_id', 'timestamp')[:batch_size])
+            if not batch:
+                break
+
+            totals = {}
+            for _, meeting_id, event, user_id, timestamp in batch:
+                total = totals.setdefault((meeting_id, event, user_id), {'count': 0, 'first': timestamp, 'last': timestamp})
+                total['count'] += 1
+                total['first'] = min(total['first'], timestamp)
+                total['last'] = max(total['last'], timestamp)
+
+            for (meeting_id, event, user_id), total in totals.items():
+                summary, created = EventSummary.objects.select_for_update().get_or_create(meeting_id=meeting_id, event=event, user_id=user_id,
+                        defaults={'count': total['count'], 'first': total['first'], 'last': total['last']})
+                if not created:
+                    summary.count += total['count']
+                    summary.first = min(summary.first, total['first'])
+                    summary.last = max(summary.last, total['last'])
+                    summary.save()
+
+            Event.objects.filter(id__in=[row[0] for row in batch]).delete()
+            compacted += len(batch)
+
+    return compacted
+
 class Webhook(models.Model):
     EVENT_TYPES = [
             ('MS', 'Meeting Started'),
@@ -40,13 +115,41 @@ class Webhook(models.Model):
     event = models.CharField(max_length=3, choices=EVENT_TYPES)
     meeting_id = models.BigIntegerField()
     data = models.TextField(default='', blank=True)
-    raw = models.TextField(default='', blank=True)
+    raw = models.TextField(default='', blank=True) # the request body, in rows from before `payload`
+
+    # The notification, or the parts of it the app uses (see payloads.py)
+    payload = models.BinaryField(null=True, blank=True, default=None)
+
+    # Zoom sometimes delivers the same notification several times; this identifies the
+    # delivery (see views.webhook_key) so that repeats can be rejected
+    dedup_key = models.CharField(max_length=40, unique=True, null=True, blank=True, default=None)
+
+    # Who joined/registered, extracted from the payload at ingest time so that attendance can be counted in the database
+    attendee = models.CharField(max_length=255, default='', blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['meeting_id', 'event', 'timestamp'])]
 
     def __str__(self):
-        return '[%s] %s(%s): %s' % (self.timestamp.astimezone().strftime('%c %Z'), self.event, self.meeting_id, self.data)
+        return '[%s] %s(%s): %s' % (self.timestamp.astimezone().strftime('%c %Z'), self.event, self.meeting_id, self.attendee or self.data)
+
+    # The notification itself, decoded on first use
+    @cached_property
+    def body(self):
+        if self.payload is not None:
+            return zoom.json_loads(payloads.decompress(self.payload))
+        return json.loads(self.raw)
 
 class Meeting(models.Model):
+    KINDS = [
+            ('API', 'From the Zoom API'),
+            ('EV', 'From webhook events'),
+            ('ERR', 'Archiving error'),
+        ]
+
     meeting_id = models.BigIntegerField()
+    meeting_uuid = models.CharField(max_length=64, blank=True, default='') # the instance, if known
+    kind = models.CharField(max_length=3, choices=KINDS, default='API')
     title = models.TextField()
     description = models.TextField()
     time = models.DateTimeField()
@@ -56,81 +159,485 @@ class Meeting(models.Model):
 
     class Meta:
         ordering = ['-time']
+        indexes = [
+                models.Index(fields=['kind', 'time', 'id']),
+                models.Index(fields=['kind', 'meeting_id', 'time']),
+                models.Index(fields=['kind', 'meeting_uuid']),
+            ]
 
     def __str__(self):
-        return '%s [%s] %s (%s|%s)' % (self.meeting_id, self.time.astimezone().strftime('%c %Z'), self.title, self.registrants, self.participants)
+        return '%s [%s] %s (%s, %s|%s)' % (self.meeting_id, self.time.astimezone().strftime('%c %Z'), self.title, self.kind, self.registrants, self.participants)
 
-def archive_meeting(event, keep_data=False):
-    token = zoom.gen_token()
+# Attendance totals per month, kept up to date as meetings are recorded (see record_meeting)
+class MonthlyAttendance(models.Model):
+    kind = models.CharField(max_length=3, choices=Meeting.KINDS)
+    month = models.DateField() # first day of the month (in the site's time zone)
+    meetings = models.IntegerField(default=0)
+    registrants = models.IntegerField(default=0)
+    participants = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('kind', 'month')]
+        ordering = ['-month']
+
+    def __str__(self):
+        return '%s %s: %d meetings (%d|%d)' % (self.kind, self.month.strftime('%Y-%m'), self.meetings, self.registrants, self.participants)
+
+# Attendance totals per meeting ID (i.e. per series, for recurring meetings), kept up to date like MonthlyAttendance
+class SeriesAttendance(models.Model):
+    kind = models.CharField(max_length=3, choices=Meeting.KINDS)
+    meeting_id = models.BigIntegerField()
+    title = models.TextField() # of the most recent meeting
+    first = models.DateTimeField()
+    last = models.DateTimeField()
+    meetings = models.IntegerField(default=0)
+    registrants = models.IntegerField(default=0)
+    participants = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('kind', 'meeting_id')]
+
+    def __str__(self):
+        return '%s %s %s: %d meetings (%d|%d)' % (self.kind, self.meeting_id, self.title, self.meetings, self.registrants, self.participants)
+
+# Which month a meeting counts towards
+def attendance_month(time):
+    return timezone.localtime(time).date().replace(day=1)
+
+# Add meetings' numbers to the rollups (or take them away again, with sign=-1)
+# Errors aren't attendance, so they're left out
+def add_to_rollups(meetings, sign=1):
+    monthly = {}
+    series = {}
+    for meeting in meetings:
+        if meeting.kind == 'ERR':
+            continue
+
+        for totals, key in ((monthly, (meeting.kind, attendance_month(meeting.time))), (series, (meeting.kind, meeting.meeting_id))):
+            total = totals.setdefault(key, {'meetings': 0, 'registrants': 0, 'participants': 0, 'first': meeting.time, 'latest': meeting})
+            total['meetings'] += sign
+            total['registrants'] += sign * meeting.registrants
+            total['participants'] += sign * meeting.participants
+            total['first'] = min(total['first'], meeting.time)
+            if meeting.time >= total['latest'].time:
+                total['latest'] = meeting
+
+    def increments(total):
+        return {field: models.F(field) + total[field] for field in ('meetings', 'registrants', 'participants')}
+
+    with transaction.atomic():
+        for (kind, month), total in monthly.items():
+            MonthlyAttendance.objects.get_or_create(kind=kind, month=month)
+            MonthlyAttendance.objects.filter(kind=kind, month=month).update(**increments(total))
+
+        for (kind, meeting_id), total in series.items():
+            latest = total['latest']
+            row, _ = SeriesAttendance.objects.get_or_create(kind=kind, meeting_id=meeting_id,
+                    defaults={'title': latest.title, 'first': total['first'], 'last': latest.time})
+            updates = increments(total)
+            # (removing meetings leaves the date range and title alone; rebuild_rollups fixes those up)
+            if sign > 0 and latest.time >= row.last:
+                updates.update(title=latest.title, last=latest.time)
+            if sign > 0 and total['first'] < row.first:
+                updates['first'] = total['first']
+            SeriesAttendance.objects.filter(pk=row.pk).update(**updates)
+
+# Save an attendance record, and count it in the rollups
+def record_meeting(**fields):
+    with transaction.atomic():
+        meeting = Meeting.objects.create(**fields)
+        add_to_rollups([meeting])
+    return meeting
+
+# Save an attendance record for a meeting instance, replacing any record of the same kind for it
+# (so that archiving an instance again, e.g. in a backfill, doesn't count it twice), or with replace=False,
+# leaving that alone instead
+# Rows saved without the instance's UUID (including all the ones from before it was recorded) are matched
+# on the meeting ID and start time
+# Returns (meeting, created)
+def upsert_meeting(kind, meeting_uuid, replace=True, **fields):
+    with transaction.atomic():
+        rows = Meeting.objects.select_for_update().filter(kind=kind)
+        existing = rows.filter(meeting_uuid=meeting_uuid).first() if meeting_uuid else None
+        if existing is None:
+            existing = rows.filter(meeting_uuid='', meeting_id=fields['meeting_id'], time=fields['time']).first()
+        if existing is None:
+            return record_meeting(kind=kind, meeting_uuid=meeting_uuid, **fields), True
+        if not replace:
+            return existing, False
+
+        add_to_rollups([existing], sign=-1)
+        for field, value in dict(fields, meeting_uuid=meeting_uuid or existing.meeting_uuid).items():
+            setattr(existing, field, value)
+        existing.save()
+        add_to_rollups([existing])
+        return existing, False
+
+# Recompute the rollups from scratch (e.g. after editing or deleting Meeting rows by hand)
+def rebuild_rollups():
+    with transaction.atomic():
+        MonthlyAttendance.objects.all().delete()
+        SeriesAttendance.objects.all().delete()
+
+        batch = []
+        for meeting in Meeting.objects.exclude(kind='ERR').order_by().iterator():
+            batch.append(meeting)
+            if len(batch) == 1000:
+                add_to_rollups(batch)
+                batch = []
+        add_to_rollups(batch)
+
+# Merged participant report for a meeting instance (see zoom_api.get_participants)
+# These never change once the meeting is over (`final`), so then they only need to be fetched from Zoom once
+class ParticipantReport(models.Model):
+    meeting_uuid = models.CharField(max_length=64, unique=True)
+    meeting_id = models.BigIntegerField(db_index=True)
+    start = models.DateTimeField(null=True, blank=True, db_index=True) # when the meeting instance started (if known)
+    fetched = models.DateTimeField(default=timezone.now)
+    final = models.BooleanField(default=True)
+
+    def __str__(self):
+        return '%s (%s) fetched %s' % (self.meeting_id, self.meeting_uuid, self.fetched.astimezone().strftime('%c %Z'))
+
+class Participant(models.Model):
+    report = models.ForeignKey(ParticipantReport, on_delete=models.CASCADE)
+    email = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    name_key = models.CharField(max_length=255) # lowercase, for sorting/searching
+    duration = models.FloatField() # minutes
+
+    class Meta:
+        indexes = [
+                models.Index(fields=['report', 'name_key']),
+                models.Index(fields=['report', 'email']),
+            ]
+
+# Returns the stored participant report for a meeting instance, if it's final or was fetched in the last
+# `max_age` seconds, otherwise None
+def participant_report(meeting_uuid, max_age):
+    return ParticipantReport.objects.filter(
+            models.Q(final=True) | models.Q(fetched__gte=timezone.now() - timedelta(seconds=max_age)),
+            meeting_uuid=meeting_uuid).first()
+
+# Store the participants of a meeting instance, as returned by zoom_api.get_participants
+# `final` means the meeting is over, so the report won't change any more; until then, each call replaces
+# what was stored before
+# `start` is when the instance started (an aware datetime), which is what exports filter on
+def save_participants(meeting_uuid, meeting_id, people, final=True, start=None):
+    with transaction.atomic():
+        report, created = ParticipantReport.objects.get_or_create(meeting_uuid=meeting_uuid,
+                defaults={'meeting_id': meeting_id, 'final': final, 'start': start})
+        if not created:
+            if report.final:
+                return report
+            report.participant_set.all().delete()
+            report.fetched = timezone.now()
+            report.final = final
+            report.start = start or report.start
+            report.save()
+
+        Participant.objects.bulk_create([
+                Participant(report=report, email=email[:255], name=person['name'][:255],
+                        name_key=person['name'].lower()[:255], duration=person['duration'])
+                for email, person in people.items()
+            ], batch_size=1000)
+
+    return report
+
+# Local copy of a meeting's registrants, kept up to date by registration webhooks and
+# sync_registrants (see the zoom_sync_registrants command)
+class Registrant(models.Model):
+    meeting_id = models.BigIntegerField()
+    registrant_id = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    email = models.CharField(max_length=255)
+    location = models.CharField(max_length=255)
+    answers = models.TextField(default='[]') # JSON
+    sort_key = models.CharField(max_length=255) # last name, see zoom_api.registrant_sort_key
+    name_key = models.CharField(max_length=255) # lowercase, for searching
+    location_key = models.CharField(max_length=255) # lowercase, for searching
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [('meeting_id', 'registrant_id')]
+        indexes = [
+                models.Index(fields=['meeting_id', 'sort_key', 'id']),
+                models.Index(fields=['meeting_id', 'name_key']),
+                models.Index(fields=['meeting_id', 'email']),
+                models.Index(fields=['meeting_id', 'location_key']),
+            ]
+
+    def __str__(self):
+        return '%s: %s <%s>' % (self.meeting_id, self.name, self.email)
+
+    # Same format as zoom_api.get_registrants
+    def as_dict(self):
+        return {
+                'id': self.registrant_id,
+                'name': self.name,
+                'email': self.email,
+                'location': self.location,
+                'answers': json.loads(self.answers),
+            }
+
+    # Copy the fields of a cleaned-up registrant (a zoom_api.RegistrantRecord, see zoom_api.clean_registrant)
+    # Returns True if anything changed
+    def update_from(self, registrant):
+        fields = {
+                'name': registrant['name'][:255],
+                'email': registrant['email'][:255],
+                'location': registrant['location'][:255],
+                'answers': json.dumps(registrant['answers']),
+                'sort_key': registrant.sort_key[:255],
+                'name_key': registrant['name'].lower()[:255],
+                'location_key': registrant['location'].lower()[:255],
+            }
+
+        changed = False
+        for field, value in fields.items():
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        return changed
+
+# When each meeting's registrants were last fully synced with Zoom
+class RegistrantSync(models.Model):
+    meeting_id = models.BigIntegerField(unique=True)
+    synced = models.DateTimeField()
+
+    def __str__(self):
+        return '%s synced %s' % (self.meeting_id, self.synced.astimezone().strftime('%c %Z'))
+
+REGISTRANT_FIELDS = ['name', 'email', 'location', 'answers', 'sort_key', 'name_key', 'location_key', 'updated']
+
+# Whether the stored registrants for a meeting have been fully synced with Zoom in the last `max_age` seconds
+def registrants_synced(meeting_id, max_age):
+    return RegistrantSync.objects.filter(meeting_id=meeting_id, synced__gte=timezone.now() - timedelta(seconds=max_age)).exists()
+
+# Make the stored registrants for a meeting match a full list from zoom_api.get_registrants
+# Only the rows that changed are written
+# Returns the number of registrants added, changed and removed
+def sync_registrants(meeting_id, registrants):
+    now = timezone.now()
+
+    with transaction.atomic():
+        existing = {r.registrant_id: r for r in Registrant.objects.filter(meeting_id=meeting_id)}
+        added = []
+        changed = []
+
+        for registrant in registrants:
+            row = existing.pop(registrant['id'], None)
+            if row is None:
+                row = Registrant(meeting_id=meeting_id, registrant_id=registrant['id'], updated=now)
+                row.update_from(registrant)
+                added.append(row)
+            elif row.update_from(registrant):
+                row.updated = now
+                changed.append(row)
+
+        Registrant.objects.bulk_create(added, batch_size=1000)
+        Registrant.objects.bulk_update(changed, REGISTRANT_FIELDS, batch_size=1000)
+        Registrant.objects.filter(pk__in=[r.pk for r in existing.values()]).delete()
+        RegistrantSync.objects.update_or_create(meeting_id=meeting_id, defaults={'synced': now})
+
+    return len(added), len(changed), len(existing)
+
+# Add/update a single registrant (e.g. from a registration webhook)
+def save_registrant(meeting_id, registrant):
+    row = Registrant.objects.filter(meeting_id=meeting_id, registrant_id=registrant['id']).first()
+    if row is None:
+        row = Registrant(meeting_id=meeting_id, registrant_id=registrant['id'])
+
+    if row.update_from(registrant) or row.pk is None:
+        row.updated = timezone.now()
+        row.save()
+
+# Running count of unique attendees for one meeting instance, updated as webhooks arrive
+# (registrations aren't tied to an instance, so those are tallied per meeting, with a blank UUID)
+class AttendeeTally(models.Model):
+    meeting_id = models.BigIntegerField()
+    meeting_uuid = models.CharField(max_length=64, blank=True)
+    event = models.CharField(max_length=3, choices=Webhook.EVENT_TYPES)
+    count = models.IntegerField(default=0)
+    sketch = models.BinaryField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('meeting_id', 'meeting_uuid', 'event')]
+
+    def __str__(self):
+        return '%s(%s %s): %d' % (self.event, self.meeting_id, self.meeting_uuid, self.count)
+
+# One (hashed) attendee already counted in a tally, in 'exact' mode
+class AttendeeKey(models.Model):
+    tally = models.ForeignKey(AttendeeTally, on_delete=models.CASCADE)
+    key = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = [('tally', 'key')]
+
+# Count an attendee towards the running tally for a meeting
+def count_attendee(meeting_id, meeting_uuid, event, attendee):
+    if not attendee:
+        return
+
+    tally, _ = AttendeeTally.objects.get_or_create(meeting_id=meeting_id, meeting_uuid=meeting_uuid, event=event)
+
+    if ATTENDEE_COUNTER == 'approx':
+        with transaction.atomic():
+            tally = AttendeeTally.objects.select_for_update().get(pk=tally.pk)
+            sketch = HyperLogLog(ATTENDEE_SKETCH_PRECISION, tally.sketch)
+            if sketch.add(attendee):
+                tally.sketch = bytes(sketch.registers)
+                tally.count = sketch.count()
+                tally.save()
+    else:
+        try:
+            with transaction.atomic():
+                AttendeeKey.objects.create(tally=tally, key=hashlib.sha1(attendee.encode('utf-8')).hexdigest())
+        except IntegrityError:
+            return # already counted
+
+        AttendeeTally.objects.filter(pk=tally.pk).update(count=models.F('count') + 1)
+
+# Queued background work, run by the zoom_worker management command
+# (lives in the database so that there's no need for a separate message broker)
+class Job(models.Model):
+    TASK_TYPES = [
+            ('AR', 'Archive Meeting'),
+        ]
+
+    STATUSES = [
+            ('P', 'Pending'),
+            ('R', 'Running'),
+            ('F', 'Failed'),
+        ]
+
+    created = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    task = models.CharField(max_length=2, choices=TASK_TYPES)
+    status = models.CharField(max_length=1, choices=STATUSES, default='P')
+    attempts = models.IntegerField(default=0)
+    webhook = models.ForeignKey(Webhook, null=True, blank=True, on_delete=models.SET_NULL)
+    error = models.TextField(default='', blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return '[%s] %s (%s, %d attempts)' % (self.created.astimezone().strftime('%c %Z'), self.get_task_display(), self.get_status_display(), self.attempts)
+
+# Save attendance numbers for a meeting that just ended, then purge the collected webhook data
+# The database writes happen in one transaction, after all the Zoom API calls
+# Raises if anything goes wrong (see archive_meeting for a version that records the error instead)
+def archive_meeting_data(event, keep_data=False):
+    token = zoom.tokens
     meeting_id = int(event.meeting_id)
-    raw = json.loads(event.raw)
-    try:
-        meeting, _ = zoom.get_meeting(token, meeting_id)
-        if meeting['settings']['approval_type'] == 0: # registration required and auto-approved
+    obj = event.body['payload']['object']
+    start_time = pytz.utc.localize(zoom.parse_time(obj['start_time'])) if 'start_time' in obj else None
+    end_time = pytz.utc.localize(zoom.parse_time(obj['end_time'])) if 'end_time' in obj else None
+
+    # Get everything we need from Zoom first, so that the transaction the results are written in isn't held
+    # open across API calls (which, with retries and rate limiting, can take minutes)
+    meeting, _ = zoom.get_meeting(token, meeting_id)
+    api_counts = None
+    if meeting['settings']['approval_type'] == 0: # registration required and auto-approved
+        try:
+            registrants, _ = zoom.get_registrants(token, meeting_id)
+            participants, _ = zoom.get_participants(token, obj.get('uuid') or meeting_id)
+        except:
+            # Sometimes these API calls for attendance fail with a "no such meeting" error
+            # despite the fact that get_meeting just succeeded for the same meeting ID. No
+            # idea why that happens, but there's not much we can do about it, so just silently
+            # do nothing.
+            pass
+        else:
+            api_counts = (registrants, participants)
+
+    with transaction.atomic():
+        if api_counts is not None:
             # Save a record of the attendance numbers based on what the Zoom API says
-            try:
-                registrants, _ = zoom.get_registrants(token, meeting_id)
-                participants, _ = zoom.get_participants(token, meeting_id)
-            except:
-                # Sometimes these API calls for attendance fail with a "no such meeting" error
-                # despite the fact that get_meeting just succeeded for the same meeting ID. No
-                # idea why that happens, but there's not much we can do about it, so just silently
-                # do nothing.
-                pass
-            else:
-                meeting_obj = Meeting.objects.create(
-                        meeting_id=meeting_id,
-                        title=meeting['topic'],
-                        description=meeting['agenda'],
-                        time=pytz.utc.localize(datetime.strptime(meeting['start_time'], '%Y-%m-%dT%H:%M:%SZ')),
-                        duration=timedelta(minutes=meeting['duration']),
-                        registrants=len(registrants),
-                        participants=len(participants))
-                meeting_obj.save()
+            registrants, participants = api_counts
+
+            # the meeting is over, so this is the final participant report
+            if obj.get('uuid'):
+                save_participants(obj['uuid'], meeting_id, participants, start=start_time)
+
+            upsert_meeting('API', obj.get('uuid', ''),
+                    meeting_id=meeting_id,
+                    title=meeting['topic'],
+                    description=meeting['agenda'],
+                    time=pytz.utc.localize(zoom.parse_time(meeting['start_time'])),
+                    duration=timedelta(minutes=meeting['duration']),
+                    registrants=len(registrants),
+                    participants=len(participants))
 
         # Save another record based on the number of webhook events received (this is always ~10% higher than the API numbers, no idea why)
         if meeting['type'] == 2: # non-recurring meeting
             hooks = Webhook.objects.filter(meeting_id=meeting_id)
         else:
-            hooks = Webhook.objects.filter(meeting_id=meeting_id,
-                    timestamp__gte=datetime.strftime(datetime.strptime(raw['payload']['object']['start_time'], '%Y-%m-%dT%H:%M:%SZ'), '%Y-%m-%d %H:%M:%S-00:00'),
-                    timestamp__lte=datetime.strftime(datetime.strptime(raw['payload']['object']['end_time'], '%Y-%m-%dT%H:%M:%SZ'), '%Y-%m-%d %H:%M:%S-00:00'))
-        reg_hooks = hooks.filter(meeting_id=meeting_id, event='MRC')
-        part_hooks = hooks.filter(meeting_id=meeting_id, event='JWR')
-        if len(part_hooks) > 0:
-            meeting_obj = Meeting.objects.create(
+            hooks = Webhook.objects.filter(meeting_id=meeting_id, timestamp__gte=start_time, timestamp__lte=end_time)
+        if ATTENDEE_COUNTER:
+            tallies = AttendeeTally.objects.filter(meeting_id=meeting_id, meeting_uuid__in=('', obj.get('uuid', '')))
+            counts = {'registrants': 0, 'participants': 0}
+            for tally in tallies:
+                counts['registrants' if tally.event == 'MRC' else 'participants'] += tally.count
+        else:
+            counts = hooks.aggregate(
+                    registrants=models.Count('attendee', distinct=True, filter=models.Q(event='MRC') & ~models.Q(attendee='')),
+                    participants=models.Count('attendee', distinct=True, filter=models.Q(event='JWR') & ~models.Q(attendee='')))
+        if counts['participants'] > 0:
+            upsert_meeting('EV', obj.get('uuid', ''),
                     meeting_id=meeting_id,
-                    title=meeting['topic'] + ' (from events)',
+                    title=meeting['topic'],
                     description=meeting['agenda'],
-                    time=pytz.utc.localize(datetime.strptime(raw['payload']['object']['start_time'], '%Y-%m-%dT%H:%M:%SZ')),
-                    duration=datetime.strptime(raw['payload']['object']['end_time'], '%Y-%m-%dT%H:%M:%SZ') - datetime.strptime(raw['payload']['object']['start_time'], '%Y-%m-%dT%H:%M:%SZ'),
-                    registrants=len(set(ast.literal_eval(h.data)['user_name'] for h in reg_hooks)),
-                    participants=len(set(ast.literal_eval(h.data)['user_name'] for h in part_hooks)))
-            meeting_obj.save()
+                    time=start_time,
+                    duration=end_time - start_time,
+                    registrants=counts['registrants'],
+                    participants=counts['participants'])
 
         # purge collected data
+        # (the "meeting ended" notification itself is kept -- it has no attendee data in it, and
+        # its dedup_key stops a late repeat of the notification from archiving the meeting again)
         if not keep_data:
-            hooks.delete()
-            event.delete()
+            hooks.exclude(event='ME').delete()
+            if ATTENDEE_COUNTER:
+                tallies.delete()
+
+# Record a failure to archive a meeting as a "meeting", so that it at least shows up somewhere
+def archive_error(meeting_id, error):
+    Meeting.objects.create(
+            meeting_id=meeting_id,
+            kind='ERR',
+            title='Error cleaning up %s' % meeting_id,
+            description=error,
+            time=datetime.now(),
+            duration=timedelta(0),
+            registrants=0,
+            participants=0)
+
+    # TODO email error report
+
+def archive_meeting(event, keep_data=False):
+    try:
+        archive_meeting_data(event, keep_data)
     except:
         print(traceback.format_exc())
 
         # create a "meeting" to record the error
-        meeting_obj = Meeting.objects.create(
-                meeting_id=meeting_id,
-                title='Error cleaning up %s' % meeting_id,
-                description=traceback.format_exc(),
-                time=datetime.now(),
-                duration=timedelta(0),
-                registrants=0,
-                participants=0)
-        meeting_obj.save()
-
-        # TODO email error report
+        archive_error(int(event.meeting_id), traceback.format_exc())
 
 @receiver(post_save, sender=Webhook)
 def on_webhook(sender, instance, created, **kwargs):
     if created:
+        # a meeting starting/ending changes what the meetings list shows
+        # (joins and registrations don't, so those leave the cache alone)
+        if instance.event in ('MS', 'ME'):
+            caching.invalidate_meetings()
+
+        # archiving makes several Zoom API calls, so hand it off to the background worker
+        # instead of making Zoom wait for a response (and retry the webhook if it's slow)
         if instance.event == 'ME':
-            archive_meeting(instance)
+            Job.objects.create(task='AR', webhook=instance)
 
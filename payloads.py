@@ -0,0 +1,83 @@
+from zoom import zoom_api as zoom
+import zlib
+
+# Compact storage for webhook notifications
+#
+# New notifications are stored as just the fields the app reads back later (see reduce), re-serialized
+# as JSON. That's both smaller than the whole body and cheaper than compressing it, since the view has
+# already parsed it anyway.
+#
+# Older rows hold the whole request body instead. Zoom's notifications are small JSON documents (a few
+# hundred bytes) that mostly repeat the same keys and boilerplate, which is too little data for plain
+# zlib to learn much from, so those were deflated against a preset dictionary of typical notification
+# content, which roughly halves them.
+#
+# The first byte of a stored value says how it was encoded, so older rows can still be read.
+
+STORED = 0 # as is (for bodies that don't compress)
+DEFLATE_V1 = 1 # raw deflate, with ZDICT_V1 as the preset dictionary
+REDUCED_V1 = 2 # the fields that are kept (see reduce), as JSON
+
+# Typical webhook content (zlib finds matches near the end of the dictionary more cheaply, so the most
+# common strings go last). Never change this: add a new version instead.
+ZDICT_V1 = (
+    b'"purchasing_time_frame":"","role_in_purchase_process":"","no_of_employees":"","comments":"",'
+    b'"industry":"","org":"","job_title":"","address":"","zip":"","phone":"","state":"",'
+    b'"custom_questions":[{"title":"","value":""}],"status":"approved","city":"","country":"US",'
+    b'"join_url":"https://zoom.us/w/","registrant":{"id":"","first_name":"","last_name":"","email":"@gmail.com"'
+    b'"event":"meeting.registration_created","event":"meeting.started","event":"meeting.ended",'
+    b'"end_time":"2020-05-01T19:00:00Z","timezone":"America/New_York","duration":60,"type":2,'
+    b'"host_id":"","topic":"","start_time":"2020-05-01T18:00:00Z",'
+    b'"participant":{"user_id":"","user_name":"","id":"","join_time":"2020-05-01T18:00:00Z"},'
+    b'{"event":"meeting.participant_joined_waiting_room","payload":{"account_id":"","object":{"uuid":"==","id":'
+    b'},"event_ts":16'
+)
+
+# Deflate level: a fast one, since the higher levels barely shrink bodies this small (about 2%)
+LEVEL = 3
+
+# The parts of a notification that are kept (these are what views.webhook_key, views.attendee_key and
+# models.archive_meeting_data use): the top-level fields, the meeting object's fields, and the fields of
+# the participant/registrant in it
+KEEP = ('event', 'event_ts')
+KEEP_OBJECT = ('id', 'uuid', 'start_time', 'end_time')
+KEEP_PERSON = {
+        'participant': ('user_id', 'user_name', 'id', 'join_time'),
+        'registrant': ('id', 'email', 'first_name', 'last_name'),
+    }
+
+# Copy the fields that are kept out of a parsed notification
+def reduce(data):
+    reduced = {field: data[field] for field in KEEP if field in data}
+    if 'payload' in data:
+        obj = data['payload']['object']
+        kept = {field: obj[field] for field in KEEP_OBJECT if field in obj}
+        for sub, fields in KEEP_PERSON.items():
+            if sub in obj:
+                kept[sub] = {field: obj[sub][field] for field in fields if field in obj[sub]}
+        reduced['payload'] = {'object': kept}
+    return reduced
+
+# Encode a parsed notification for storage
+def pack(data):
+    return bytes([REDUCED_V1]) + zoom.json_dumps(reduce(data))
+
+# Encode a whole request body (bytes) for storage, the way older rows were
+def compress(body):
+    deflate = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, zdict=ZDICT_V1)
+    packed = deflate.compress(body) + deflate.flush()
+    if len(packed) < len(body):
+        return bytes([DEFLATE_V1]) + packed
+    return bytes([STORED]) + body
+
+# Decode a stored value back into JSON (bytes): the original request body, or for newer rows the fields that were kept
+def decompress(blob):
+    blob = bytes(blob) # some database backends give us a memoryview
+    if blob[0] == REDUCED_V1:
+        return blob[1:]
+    if blob[0] == DEFLATE_V1:
+        inflate = zlib.decompressobj(-15, zdict=ZDICT_V1)
+        return inflate.decompress(blob[1:]) + inflate.flush()
+    if blob[0] == STORED:
+        return blob[1:]
+    raise ValueError('Unknown payload format %d' % blob[0])
@@ -0,0 +1,174 @@
+import asyncio
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from zoom import secrets
+
+# Token-bucket rate limiting for all Zoom API traffic on this machine
+#
+# Zoom limits requests per second by endpoint class (light/medium/heavy), per account. Every process
+# that talks to Zoom (web workers, the job worker, management commands) shares one set of buckets,
+# kept in a small state file under an exclusive lock. Interactive requests (page views) can use the
+# whole bucket, while background work is kept out of a reserved share of it, so that a backfill or
+# sync can't starve the pages that people are waiting on.
+
+ENABLED = getattr(secrets, 'ZOOM_RATE_LIMIT', True)
+
+# Endpoint class -> (requests per second, burst size)
+RATE_LIMITS = getattr(secrets, 'ZOOM_RATE_LIMITS', {
+        'light': (20, 40),
+        'medium': (10, 20),
+        'heavy': (5, 10),
+    })
+
+# Fraction of each bucket that only interactive requests may use
+BACKGROUND_RESERVE = getattr(secrets, 'ZOOM_RATE_LIMIT_RESERVE', 0.5)
+
+# Interactive requests that would have to wait longer than this (seconds) fail instead (with a 429)
+MAX_WAIT = getattr(secrets, 'ZOOM_RATE_LIMIT_MAX_WAIT', 5)
+
+STATE_FILE = getattr(secrets, 'ZOOM_RATE_LIMIT_FILE', os.path.join(tempfile.gettempdir(), 'zoom-rate-limit.json'))
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_priority = contextvars.ContextVar('zoom_priority', default=INTERACTIVE)
+
+# Used instead of the file lock where there's no fcntl (in which case the limit is only per process)
+_local_lock = threading.Lock()
+_local_state = {}
+
+class RateLimited(Exception):
+    def __init__(self, wait):
+        self.wait = wait
+
+# Mark the Zoom API calls made inside this block as background work
+@contextmanager
+def background():
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+# Which of Zoom's rate limit classes an API request falls into
+def classify(method, path):
+    if path.startswith('report/') or path.startswith('past_meetings/'):
+        return 'heavy'
+    if method == 'GET' and re.fullmatch(r'users/[^/]+/meetings|meetings/[^/]+/registrants', path):
+        return 'medium'
+    return 'light'
+
+# Read/modify/write the shared bucket state, holding the lock
+@contextmanager
+def locked_state():
+    if fcntl is None:
+        with _local_lock:
+            yield _local_state
+        return
+
+    with open(STATE_FILE, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+
+            yield state
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Try to take a token from a bucket
+# Returns 0 if one was taken, otherwise how many seconds until one will be available
+def try_acquire(bucket, priority):
+    rate, burst = RATE_LIMITS[bucket]
+    floor = burst * BACKGROUND_RESERVE if priority == BACKGROUND else 0
+
+    with locked_state() as state:
+        now = time.time()
+        tokens, last = state.get(bucket, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+
+        if tokens - 1 >= floor:
+            state[bucket] = (tokens - 1, now)
+            return 0
+
+        state[bucket] = (tokens, now)
+        return (floor + 1 - tokens) / rate
+
+# Wait for permission to make an API request
+# Raises RateLimited if an interactive request would have to wait longer than MAX_WAIT
+def acquire(method, path):
+    if not ENABLED:
+        return
+
+    bucket = classify(method, path)
+    priority = _priority.get()
+    waited = 0
+
+    while True:
+        wait = try_acquire(bucket, priority)
+        if wait == 0:
+            return
+
+        if priority == INTERACTIVE and waited + wait > MAX_WAIT:
+            raise RateLimited(wait)
+
+        time.sleep(wait)
+        waited += wait
+
+# Same as acquire, for async code (waits without blocking the event loop)
+# The shared state is behind a file lock that other processes may be holding, so that part runs in a thread
+async def acquire_async(method, path):
+    if not ENABLED:
+        return
+
+    bucket = classify(method, path)
+    priority = _priority.get()
+    waited = 0
+    loop = asyncio.get_running_loop()
+
+    while True:
+        wait = await loop.run_in_executor(None, try_acquire, bucket, priority)
+        if wait == 0:
+            return
+
+        if priority == INTERACTIVE and waited + wait > MAX_WAIT:
+            raise RateLimited(wait)
+
+        await asyncio.sleep(wait)
+        waited += wait
+
+# Zoom rate limited us anyway (e.g. because something else is using the same account), so empty the
+# bucket, making every process back off
+def throttle(method, path):
+    if not ENABLED:
+        return
+
+    with locked_state() as state:
+        state[classify(method, path)] = (0, time.time())
+
+# Same as throttle, for async code (takes the file lock in a thread, like acquire_async)
+async def throttle_async(method, path):
+    if not ENABLED:
+        return
+
+    await asyncio.get_running_loop().run_in_executor(None, throttle, method, path)
@@ -0,0 +1,50 @@
+import hashlib
+import math
+
+# HyperLogLog cardinality estimator (Flajolet et al. 2007)
+#
+# Counts unique values in constant space: 2**precision one-byte registers, with a
+# standard error of about 1.04/sqrt(2**precision) (so ~1.6% for the default of 12).
+# The registers are a plain bytearray, so they can be stored in a BinaryField and
+# merged/updated later.
+class HyperLogLog(object):
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+
+        if registers:
+            self.registers = bytearray(registers)
+            assert len(self.registers) == self.m, 'Sketch was created with a different precision'
+        else:
+            self.registers = bytearray(self.m)
+
+    # Add a value to the sketch
+    # Returns True if the sketch changed (i.e. the value might be new)
+    def add(self, value):
+        h = int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+
+        # first `precision` bits pick the register, the rest give the rank (position of the first 1 bit)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    # Estimated number of unique values added
+    def count(self):
+        if self.m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(self.m, 0.673)
+
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+
+        # small range correction: linear counting is more accurate while many registers are still empty
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)
+
+        return int(round(estimate))
@@ -4,11 +4,14 @@ from django import template
 register = template.Library()
 
 # Parse a date from Zoom's idiosyncratic format into a datetime
+# (meetings from zoom_api come with theirs parsed already, as `start` and `end`, so prefer those)
 @register.filter
 def zoom_date(dt_str):
+    if isinstance(dt_str, datetime.datetime):
+        return dt_str
     assert dt_str[-1] == 'Z'
-    dt = datetime.datetime.strptime(dt_str, '%Y-%m-%dT%H:%M:%SZ')
-    return dt.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=0)))
+    dt = datetime.datetime.fromisoformat(dt_str[:-1])
+    return dt.replace(tzinfo=datetime.timezone.utc)
 
 # Split a string on a delimiter
 @register.filter
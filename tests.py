@@ -1,3 +1,361 @@
-from django.test import TestCase
+import asyncio
+from datetime import datetime, timedelta
+import json
+import random
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+import pytz
+
+from zoom import backfill
+from zoom import jobs
+from zoom import models
+from zoom import payloads
+from zoom import secrets
+from zoom import zoom_api as zoom
+from zoom.models import Job, Meeting, MonthlyAttendance, ParticipantReport, Webhook, save_participants
+
+# Only needed for the async views (it requires httpx)
+try:
+    from zoom import zoom_api_async
+except ImportError:
+    zoom_api_async = None
+
+class ExportParticipantsTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('exporter'))
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_participants', kwargs={'fmt': 'json'}), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_filters_on_meeting_start_not_fetch_time(self):
+        # held on May 1st, but its report was only fetched (e.g. by a backfill) weeks later
+        save_participants('late==', 1, {'a@example.com': {'name': 'A', 'duration': 30}},
+                start=pytz.utc.localize(datetime(2020, 5, 1, 18)))
+        ParticipantReport.objects.filter(meeting_uuid='late==').update(fetched=pytz.utc.localize(datetime(2020, 6, 15)))
+
+        # held in April, with its report fetched on May 1st
+        save_participants('early==', 2, {'b@example.com': {'name': 'B', 'duration': 45}},
+                start=pytz.utc.localize(datetime(2020, 4, 10, 18)))
+        ParticipantReport.objects.filter(meeting_uuid='early==').update(fetched=pytz.utc.localize(datetime(2020, 5, 1, 19)))
+
+        rows = self.export(**{'from': '2020-05-01', 'to': '2020-05-02'})
+        self.assertEqual([row['meeting_uuid'] for row in rows], ['late=='])
+        self.assertEqual(rows[0]['meeting_start'], '2020-05-01T18:00:00+00:00')
+
+@mock.patch.object(secrets, 'WEBHOOK_VERIFICATION_TOKEN', 'token', create=True)
+class WebhookDedupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self, event, obj):
+        body = json.dumps({'event': event, 'event_ts': 1588356000000, 'payload': {'object': obj}})
+        return self.client.post(reverse('webhook'), body, content_type='application/json', HTTP_AUTHORIZATION='token')
+
+    def registration(self):
+        return {'id': 1, 'uuid': 'abc==', 'registrant': {'id': 'r1', 'email': 'a@example.com', 'first_name': 'A'}}
+
+    def test_repeat_delivery_is_ignored(self):
+        with mock.patch.object(models, 'ATTENDEE_COUNTER', False):
+            self.post('meeting.registration_created', self.registration())
+            cache.clear() # as if the cache had forgotten it, so the unique index has to catch it
+            response = self.post('meeting.registration_created', self.registration())
+
+        self.assertEqual(response.content, b'Webhook already received')
+        self.assertEqual(Webhook.objects.count(), 1)
+
+    def test_other_integrity_errors_are_not_duplicates(self):
+        with mock.patch.object(models, 'save_registrant', side_effect=IntegrityError('registrant race')):
+            with self.assertRaises(IntegrityError):
+                self.post('meeting.registration_created', self.registration())
+
+        # nothing was recorded, so Zoom's retry has to get through
+        response = self.post('meeting.registration_created', self.registration())
+        self.assertEqual(response.content, b'Webhook received')
+
+    def test_stores_only_the_fields_used(self):
+        obj = dict(self.registration(), topic='Talk', start_time='2020-05-01T18:00:00Z')
+        obj['registrant'].update(city='Springfield', custom_questions=[{'title': 'Q', 'value': 'A'}])
+        with mock.patch.object(models, 'ATTENDEE_COUNTER', False):
+            self.post('meeting.registration_created', obj)
+
+        self.assertEqual(Webhook.objects.get().body, {'event': 'meeting.registration_created', 'event_ts': 1588356000000, 'payload': {'object': {
+                'id': 1, 'uuid': 'abc==', 'start_time': '2020-05-01T18:00:00Z',
+                'registrant': {'id': 'r1', 'email': 'a@example.com', 'first_name': 'A'}}}})
+
+    def test_reads_older_rows(self):
+        body = json.dumps({'event': 'meeting.ended', 'payload': {'object': {'id': 1, 'topic': 'Talk'}}}).encode('utf-8')
+        for payload in (payloads.compress(body), bytes([payloads.STORED]) + body):
+            self.assertEqual(Webhook(payload=payload).body['payload']['object']['topic'], 'Talk')
+
+# The interval merging get_participants used before merged_minutes replaced it, kept as the reference
+def union_sorted(intervals):
+    if len(intervals) <= 1:
+        return intervals
+
+    a = intervals[0]
+    b = intervals[1]
+
+    if b[0] <= a[1]:
+        return union_sorted([(a[0], max(a[1], b[1]))] + intervals[2:])
+
+    return [a] + union_sorted(intervals[1:])
+
+def reference_minutes(intervals):
+    return sum(map(lambda iv: (iv[1] - iv[0]).total_seconds() / 60, union_sorted(sorted(intervals))))
+
+def participant_records(people):
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+    return [{'user_email': email, 'name': email.split('@')[0], 'join_time': join.strftime(fmt), 'leave_time': leave.strftime(fmt)}
+            for email, intervals in people.items() for join, leave in intervals]
+
+class MergedMinutesTests(SimpleTestCase):
+    START = datetime(2020, 5, 1, 18)
+
+    def at(self, minutes):
+        return self.START + timedelta(minutes=minutes)
+
+    def cases(self):
+        at = self.at
+        return {
+                'single@example.com': [(at(0), at(30))],
+                'overlapping@example.com': [(at(0), at(20)), (at(10), at(30)), (at(25), at(40))],
+                'nested@example.com': [(at(0), at(60)), (at(10), at(20)), (at(15), at(50))],
+                'touching@example.com': [(at(0), at(10)), (at(10), at(20)), (at(20), at(25))],
+                'disjoint@example.com': [(at(0), at(10)), (at(30), at(45))],
+                'repeated@example.com': [(at(5), at(15)), (at(5), at(15)), (at(0), at(15))],
+                'seconds@example.com': [(at(0), at(0.5)), (at(0.25), at(1.75)), (at(3), at(3))],
+            }
+
+    def random_cases(self, people=50, seed=0):
+        rng = random.Random(seed)
+        cases = {}
+        for i in range(people):
+            intervals = []
+            for _ in range(rng.randrange(1, 8)):
+                join = self.at(rng.randrange(0, 120 * 60) / 60)
+                intervals.append((join, join + timedelta(seconds=rng.randrange(0, 3600))))
+            cases['person%d@example.com' % i] = intervals
+        return cases
+
+    def assertMatchesReference(self, cases, people):
+        self.assertEqual(set(people), set(cases))
+        for email, intervals in cases.items():
+            self.assertAlmostEqual(people[email]['duration'], reference_minutes(intervals), places=9, msg=email)
+
+    def test_merged_minutes(self):
+        for email, intervals in dict(self.cases(), **self.random_cases()).items():
+            self.assertAlmostEqual(zoom.merged_minutes(sorted(intervals)), reference_minutes(intervals), places=9, msg=email)
+
+    def test_linear_summary(self):
+        for cases in (self.cases(), self.random_cases()):
+            self.assertMatchesReference(cases, zoom.summarize_participants(participant_records(cases), use_numpy=False))
+
+    @unittest.skipIf(zoom.numpy is None, 'NumPy is not installed')
+    def test_numpy_summary(self):
+        for cases in (self.cases(), self.random_cases()):
+            self.assertMatchesReference(cases, zoom.summarize_participants(participant_records(cases), use_numpy=True))
+
+    @unittest.skipIf(zoom.numpy is None, 'NumPy is not installed')
+    def test_numpy_threshold(self):
+        cases = self.cases()
+        records = participant_records(cases)
+
+        for threshold, numpy_used in ((len(records) + 1, False), (len(records), True)):
+            with mock.patch.object(zoom, 'NUMPY_THRESHOLD', threshold), \
+                    mock.patch.object(zoom, 'merged_minutes_numpy', wraps=zoom.merged_minutes_numpy) as merge:
+                people = zoom.summarize_participants(records)
+
+            self.assertEqual(merge.called, numpy_used)
+            self.assertMatchesReference(cases, people)
+
+# How list_meetings matched recurring meetings to their occurrences before it looked series up concurrently,
+# kept as the reference
+def list_meetings_v1(token, user='me', typ='upcoming'):
+    meetings = []
+    params = {'type': typ, 'page_size': zoom.MAX_PAGE_SIZE}
+
+    while True:
+        data, code = zoom.zoom_request(token, 'users/%s/meetings' % user, params)
+        if code != 200:
+            break
+
+        meetings += sorted(data['meetings'], key=lambda m: m['start_time'])
+
+        if 'next_page_token' in data and data['next_page_token'] != '':
+            params['next_page_token'] = data['next_page_token']
+        else:
+            break
+
+    cache = {}
+    for m in reversed(meetings):
+        if m['type'] == 8:
+            if m['id'] not in cache:
+                cache[m['id']], _ = zoom.zoom_request(token, 'meetings/%d' % m['id'])
+
+            for occ in cache[m['id']]['occurrences']:
+                if occ['start_time'] == m['start_time']:
+                    m['occurrence_id'] = occ['occurrence_id']
+                    break
+            else:
+                meetings.remove(m)
+
+    return meetings, code
+
+class ListMeetingsTests(SimpleTestCase):
+    # two pages of the meeting list (each sorted separately), with two recurring series
+    PAGES = {
+            None: {'next_page_token': 'page2', 'meetings': [
+                {'id': 1, 'type': 2, 'topic': 'A', 'start_time': '2020-05-03T10:00:00Z'},
+                {'id': 10, 'type': 8, 'topic': 'Series 1', 'start_time': '2020-05-08T10:00:00Z'},
+                {'id': 10, 'type': 8, 'topic': 'Series 1', 'start_time': '2020-05-01T10:00:00Z'}, # already in the past
+                {'id': 2, 'type': 2, 'topic': 'B', 'start_time': '2020-05-02T10:00:00Z'},
+            ]},
+            'page2': {'next_page_token': '', 'meetings': [
+                {'id': 20, 'type': 8, 'topic': 'Series 2', 'start_time': '2020-05-11T10:00:00Z'}, # occurrence was deleted
+                {'id': 10, 'type': 8, 'topic': 'Series 1', 'start_time': '2020-05-15T10:00:00Z'},
+                {'id': 20, 'type': 8, 'topic': 'Series 2', 'start_time': '2020-05-04T10:00:00Z'},
+                {'id': 3, 'type': 2, 'topic': 'C', 'start_time': '2020-05-01T09:00:00Z'},
+            ]},
+        }
+
+    # only upcoming occurrences are listed (and two can share a start time, in which case the first wins)
+    SERIES = {
+            10: {'id': 10, 'type': 8, 'occurrences': [
+                {'occurrence_id': '1588932000000', 'start_time': '2020-05-08T10:00:00Z'},
+                {'occurrence_id': '1589536800000', 'start_time': '2020-05-15T10:00:00Z'},
+                {'occurrence_id': '1589536800001', 'start_time': '2020-05-15T10:00:00Z'},
+            ]},
+            20: {'id': 20, 'type': 8, 'occurrences': [
+                {'occurrence_id': '1588586400000', 'start_time': '2020-05-04T10:00:00Z'},
+            ]},
+        }
+
+    def fake_request(self, token, path, params={}, method='GET'):
+        self.requests.append(path)
+        if path == 'users/me/meetings':
+            return json.loads(json.dumps(self.PAGES[params.get('next_page_token')])), 200
+        return json.loads(json.dumps(self.SERIES[int(path.split('/')[1])])), 200
+
+    def setUp(self):
+        self.requests = []
+        patcher = mock.patch.object(zoom, 'zoom_request', self.fake_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_previous_behavior(self):
+        meetings, code = zoom.list_meetings('token')
+        expected, _ = list_meetings_v1('token')
+
+        self.assertEqual(code, 200)
+        self.assertEqual(meetings, expected)
+
+    def test_occurrences_and_order(self):
+        meetings, _ = zoom.list_meetings('token')
+
+        # page order is kept, past/deleted occurrences are dropped, and each series is only looked up once
+        self.assertEqual([(m['topic'], m['start_time'][:10], m.get('occurrence_id')) for m in meetings], [
+                ('B', '2020-05-02', None),
+                ('A', '2020-05-03', None),
+                ('Series 1', '2020-05-08', '1588932000000'),
+                ('C', '2020-05-01', None),
+                ('Series 2', '2020-05-04', '1588586400000'),
+                ('Series 1', '2020-05-15', '1589536800000'),
+            ])
+        self.assertEqual(sorted(path for path in self.requests if path.startswith('meetings/')), ['meetings/10', 'meetings/20'])
+        self.assertEqual(meetings[2].start, pytz.utc.localize(datetime(2020, 5, 8, 10)))
+
+    def test_without_following_recurring(self):
+        meetings, _ = zoom.list_meetings('token', follow_recurring=False)
+
+        self.assertEqual(len(meetings), 8)
+        self.assertFalse(any('occurrence_id' in m for m in meetings))
+        self.assertFalse(any(path.startswith('meetings/') for path in self.requests))
+
+class MeetingRecordTests(SimpleTestCase):
+    def test_zero_duration(self):
+        meeting = zoom.MeetingRecord({'id': 1, 'start_time': '2020-05-03T10:00:00Z', 'duration': 0})
+
+        # a meeting with no length still ends (when it starts), so the meeting pages can compare it with now
+        self.assertEqual(meeting.end, pytz.utc.localize(datetime(2020, 5, 3, 10)))
+        self.assertTrue(meeting.end < datetime.now(pytz.utc))
+
+    def test_no_duration(self):
+        meeting = zoom.MeetingRecord({'id': 1, 'start_time': '2020-05-03T10:00:00Z'})
+
+        self.assertIsNone(meeting.end)
+        self.assertNotIn('duration', meeting)
+
+class BackfillTests(TestCase):
+    INSTANCE = {'uuid': 'abc==', 'id': 1, 'topic': 'Talk', 'start_time': '2020-05-01T18:00:00Z', 'end_time': '2020-05-01T19:00:00Z', 'duration': 60}
+    INFO = {'agenda': '', 'registrants': 5}
+    PARTICIPANTS = {'a@example.com': {'name': 'A', 'duration': 60}}
+
+    def monthly(self, kind):
+        return MonthlyAttendance.objects.values_list('meetings', 'registrants', 'participants').get(kind=kind)
+
+    def test_counted_on_the_attendance_page(self):
+        backfill.save_instance(self.INSTANCE, self.INFO, self.PARTICIPANTS)
+        backfill.save_instance(self.INSTANCE, self.INFO, self.PARTICIPANTS)
+
+        self.assertEqual(Meeting.objects.filter(kind='EV').count(), 1)
+        self.assertEqual(self.monthly('EV'), (1, 5, 1))
+        self.assertEqual(self.monthly('API'), (1, 5, 1))
+
+    def test_keeps_numbers_from_webhooks(self):
+        models.upsert_meeting('EV', 'abc==', meeting_id=1, title='Talk', description='', time=pytz.utc.localize(datetime(2020, 5, 1, 18)),
+                duration=timedelta(hours=1), registrants=6, participants=3)
+        backfill.save_instance(self.INSTANCE, self.INFO, self.PARTICIPANTS)
+
+        self.assertEqual(self.monthly('EV'), (1, 6, 3))
+
+    def test_replaces_rows_without_a_uuid(self):
+        models.record_meeting(kind='API', meeting_id=1, title='Talk', description='', time=pytz.utc.localize(datetime(2020, 5, 1, 18)),
+                duration=timedelta(hours=1), registrants=4, participants=2)
+        backfill.save_instance(self.INSTANCE, self.INFO, self.PARTICIPANTS)
+
+        self.assertEqual(list(Meeting.objects.filter(kind='API').values_list('meeting_uuid', 'participants')), [('abc==', 1)])
+        self.assertEqual(self.monthly('API'), (1, 5, 1))
+
+class WorkerTests(TestCase):
+    def test_job_orphaned_by_a_restart_is_eventually_run(self):
+        # a worker died mid-job and was restarted straight away, so the job isn't stale yet
+        job = Job.objects.create(task='AR', status='R', started=timezone.now(), attempts=1)
+        worker = jobs.Worker()
+
+        with mock.patch('zoom.jobs.time.monotonic', return_value=1000):
+            self.assertEqual(worker.poll(), (0, 0))
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'R')
+
+        # an hour later, the same worker notices it's been abandoned and runs it
+        Job.objects.filter(pk=job.pk).update(started=timezone.now() - timedelta(seconds=jobs.STALE_AFTER + 1))
+        with mock.patch('zoom.jobs.time.monotonic', return_value=1000 + jobs.STALE_AFTER):
+            self.assertEqual(worker.poll(), (1, 1))
+        self.assertFalse(Job.objects.filter(pk=job.pk).exists())
+
+@unittest.skipIf(zoom_api_async is None, 'httpx is not installed')
+class AsyncClientTests(SimpleTestCase):
+    async def get_clients(self):
+        return await zoom_api_async.get_client(), await zoom_api_async.get_client()
+
+    def test_shared_within_a_loop(self):
+        first, second = asyncio.run(self.get_clients())
+        self.assertIs(first, second)
+
+    def test_closed_with_its_loop(self):
+        # as a sync view calling async code would, with a new loop each time
+        first, _ = async_to_sync(self.get_clients)()
+        second, _ = async_to_sync(self.get_clients)()
+
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertTrue(second.is_closed)
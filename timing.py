@@ -0,0 +1,138 @@
+from collections import defaultdict, deque
+import contextvars
+import re
+import threading
+import time
+
+# Instrumentation for Zoom API calls, database queries and template rendering
+#
+# Each page request gets a Trace (see views.processing_time), and everything that happens while
+# handling it is recorded there. Zoom API calls are also added to process-wide rolling stats,
+# per endpoint, for the timing_stats view.
+
+# Number of recent calls per endpoint that the rolling stats are computed over
+STATS_WINDOW = 1000
+
+class Trace(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.calls = [] # (endpoint, path, method, status, bytes, seconds)
+        self.queries = 0
+        self.query_time = 0
+        self.template_time = 0
+
+    def zoom_time(self):
+        return sum(call[5] for call in self.calls)
+
+    # Value for the Server-Timing response header (durations in ms)
+    def server_timing(self):
+        return ', '.join([
+                'zoom;dur=%.1f;desc="%d Zoom API call%s"' % (self.zoom_time() * 1000, len(self.calls), '' if len(self.calls) == 1 else 's'),
+                'db;dur=%.1f;desc="%d quer%s"' % (self.query_time * 1000, self.queries, 'y' if self.queries == 1 else 'ies'),
+                'tpl;dur=%.1f;desc="Template"' % (self.template_time * 1000),
+                'total;dur=%.1f' % ((time.perf_counter() - self.start) * 1000),
+            ])
+
+    # Summary for a structured log line
+    def as_dict(self):
+        return {
+                'total_ms': round((time.perf_counter() - self.start) * 1000, 1),
+                'zoom_ms': round(self.zoom_time() * 1000, 1),
+                'db_ms': round(self.query_time * 1000, 1),
+                'db_queries': self.queries,
+                'template_ms': round(self.template_time * 1000, 1),
+                'zoom_calls': [
+                        {'path': path, 'method': method, 'status': status, 'bytes': size, 'ms': round(seconds * 1000, 1)}
+                        for _, path, method, status, size, seconds in self.calls
+                    ],
+            }
+
+_trace = contextvars.ContextVar('zoom_trace', default=None)
+
+# Start recording into a new trace
+# Returns the trace, and a token to pass to end_trace
+def start_trace():
+    trace = Trace()
+    return trace, _trace.set(trace)
+
+def end_trace(token):
+    _trace.reset(token)
+
+# The trace being recorded into, or None
+def current_trace():
+    return _trace.get()
+
+# Wrap a function so that it runs with the caller's trace, e.g. when it's submitted to a thread pool
+# (threads don't inherit context variables on their own)
+def in_context(fn):
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # each call gets its own copy, since a context can't be entered by two threads at once
+        return context.copy().run(fn, *args, **kwargs)
+
+    return run
+
+# Database execute wrapper (see django.db.connection.execute_wrapper) that counts queries into a trace
+class QueryTimer(object):
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.trace.queries += 1
+            self.trace.query_time += time.perf_counter() - start
+
+# Rolling latency stats per Zoom API endpoint, for this process
+class EndpointStats(object):
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.latencies = defaultdict(lambda: deque(maxlen=self.window))
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, status, seconds):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.counts[endpoint] += 1
+            if not 200 <= status < 300:
+                self.errors[endpoint] += 1
+
+    # Returns {endpoint: {'calls', 'errors', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'}}, percentiles over the recent window
+    def summary(self):
+        with self.lock:
+            snapshot = {endpoint: sorted(latencies) for endpoint, latencies in self.latencies.items()}
+            counts = dict(self.counts)
+            errors = dict(self.errors)
+
+        def percentile(values, p):
+            return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+
+        return {endpoint: {
+                    'calls': counts[endpoint],
+                    'errors': errors.get(endpoint, 0),
+                    'p50_ms': percentile(values, 50),
+                    'p90_ms': percentile(values, 90),
+                    'p99_ms': percentile(values, 99),
+                    'max_ms': round(values[-1] * 1000, 1),
+                }
+                for endpoint, values in snapshot.items()}
+
+stats = EndpointStats()
+
+# Group API paths by endpoint, e.g. 'meetings/123/registrants' -> 'meetings/{id}/registrants'
+def endpoint_name(method, path):
+    return '%s %s' % (method, re.sub(r'(?<=/)(\d+|[^/]{20,})(?=/|$)', '{id}', path))
+
+# Record a Zoom API call, in the current trace (if any) and the rolling stats
+def record_call(path, method, status, size, seconds):
+    endpoint = endpoint_name(method, path)
+    stats.add(endpoint, status, seconds)
+
+    trace = _trace.get()
+    if trace is not None:
+        trace.calls.append((endpoint, path, method, status, size, seconds))
@@ -4,20 +4,33 @@ from . import views
 
 urlpatterns = [
     # list of meetings
-    path('meetings', views.meetings, name='meetings'),
+    path('meetings', views.meetings_async if views.ASYNC_VIEWS else views.meetings, name='meetings'),
 
     # meeting details (non-recurring)
-    path('meeting/<int:meeting_id>', views.meeting, name='meeting'),
+    path('meeting/<int:meeting_id>', views.meeting_async if views.ASYNC_VIEWS else views.meeting, name='meeting'),
 
     # meeting details (recurring)
-    path('meeting/<int:meeting_id>/<int:occurrence_id>', views.meeting, name='meeting'),
+    path('meeting/<int:meeting_id>/<int:occurrence_id>', views.meeting_async if views.ASYNC_VIEWS else views.meeting, name='meeting'),
+
+    # registrant/participant table rows for a meeting (JSON)
+    path('meeting/<int:meeting_id>/rows', views.meeting_rows, name='meeting_rows'),
 
     # attendance records
     path('attendance', views.attendance, name='attendance'),
 
+    # attendance records and participant reports, for download (format is 'csv' or 'json')
+    path('attendance/export.<str:fmt>', views.export_attendance, name='export_attendance'),
+    path('participants/export.<str:fmt>', views.export_participants, name='export_participants'),
+
     # start meeting redirect
     path('start/<int:meeting_id>/<str:encoded_url>', views.start, name='start'),
 
+    # change settings on many meetings at once (staff only)
+    path('bulk-settings', views.bulk_settings, name='bulk_settings'),
+
+    # Zoom API latency stats (staff only)
+    path('timing', views.timing_stats, name='timing_stats'),
+
     # webhook event notification
     path('webhook', views.webhook, name='webhook'),
 ]
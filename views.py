@@ -1,18 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
 from datetime import datetime, timedelta
+import hashlib
+import logging
 import pytz
 import json
+import time
 import urllib
 
-from django.http import HttpResponse, HttpResponseRedirect
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
-from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Max, Q, Sum
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
 from zoom import zoom_api as zoom
+from zoom import bulk
+from zoom import caching
+from zoom import payloads
 from zoom import secrets
-from zoom.models import Event, Meeting, Webhook
+from zoom import timing
+from zoom import models
+from zoom.models import Event, Meeting, MonthlyAttendance, Participant, ParticipantReport, Registrant, SeriesAttendance, Webhook
+from zoom.models import participant_report, save_participants, registrants_synced, sync_registrants
+
+# Only needed for the async views (it requires httpx)
+try:
+    from zoom import zoom_api_async as zoom_async
+except ImportError:
+    zoom_async = None
 
 # Helper class for a view to return a template to be rendered, along with the data
 class TemplateInvocation(object):
@@ -20,44 +43,129 @@ class TemplateInvocation(object):
         self.filename = filename
         self.data = data
 
+# Also log a JSON line with the timing breakdown of every page (to the 'zoom.timing' logger)
+TIMING_LOG = getattr(secrets, 'TIMING_LOG', False)
+
+timing_log = logging.getLogger('zoom.timing')
+
 # View decorator that calculates processing time and adds it to the template data, if applicable
 # The wrapped view should return a TemplateInvocation, or some other response that will be passed through
+#
+# It also records every Zoom API call, database query and the template rendering time, and reports them
+# in a Server-Timing header (visible in the browser's developer tools)
 def processing_time(view):
     def timed_view(request, *args, **kwargs):
         start = datetime.now()
+        trace, token = timing.start_trace()
 
-        result = view(request, *args, **kwargs)
+        try:
+            with connection.execute_wrapper(timing.QueryTimer(trace)):
+                result = view(request, *args, **kwargs)
 
-        if isinstance(result, TemplateInvocation):
-            result.data['processing_time'] = (datetime.now() - start)
+                if isinstance(result, TemplateInvocation):
+                    result.data['processing_time'] = (datetime.now() - start)
 
-            return render(request, result.filename, result.data)
-        else:
-            return result
+                    render_start = time.perf_counter()
+                    response = render(request, result.filename, result.data)
+                    trace.template_time = time.perf_counter() - render_start
+                else:
+                    response = result
+        finally:
+            timing.end_trace(token)
+
+        report_timing(trace, view, request, response)
+        return response
 
     return timed_view
 
+# Add a finished trace to the response (and the timing log)
+def report_timing(trace, view, request, response):
+    response['Server-Timing'] = trace.server_timing()
+    if TIMING_LOG:
+        timing_log.info(json.dumps(dict(trace.as_dict(), view=view.__name__, path=request.path, status=response.status_code)))
+
+# How long (seconds) webhook deliveries are remembered in the cache, in front of the database check
+WEBHOOK_DEDUP_TTL = getattr(secrets, 'WEBHOOK_DEDUP_TTL', 24 * 60 * 60)
+
+# Identify a webhook delivery by its event type, timestamp and meeting instance
+# (plus the participant/registrant, so that two people joining in the same millisecond aren't merged)
+def webhook_key(data):
+    obj = data['payload']['object']
+    parts = [data['event'], str(data.get('event_ts', '')), str(obj.get('uuid', obj.get('id', '')))]
+
+    for sub in ('participant', 'registrant'):
+        if sub in obj:
+            parts.append(str(obj[sub].get('user_id') or obj[sub].get('id') or obj[sub].get('user_name') or obj[sub].get('email') or ''))
+
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+# Identify the person in a participant/registrant webhook, for counting unique attendees
+# (participants are counted by display name; registrants have no display name, so use their email)
+def attendee_key(obj):
+    if 'participant' in obj:
+        return obj['participant'].get('user_name', '')
+    if 'registrant' in obj:
+        registrant = obj['registrant']
+        return registrant.get('email', '').lower() or ' '.join(filter(None, (registrant.get('first_name'), registrant.get('last_name'))))
+    return ''
+
 # Receive a web hook event notification from Zoom
 @csrf_exempt
 @require_POST
 def webhook(request):
     events = {
-            'meeting.started': ('MS', 'id'),
-            'meeting.ended': ('ME', 'id'), # FIXME not enough info for recurring meetings
-            'meeting.participant_joined_waiting_room': ('JWR', 'participant'),
-            'meeting.registration_created': ('MRC', 'registrant'),
+            'meeting.started': 'MS',
+            'meeting.ended': 'ME', # FIXME not enough info for recurring meetings
+            'meeting.participant_joined_waiting_room': 'JWR',
+            'meeting.registration_created': 'MRC',
         }
 
     if request.headers.get('authorization', '') != secrets.WEBHOOK_VERIFICATION_TOKEN:
         return HttpResponse('Bad authorization', status=403)
     else:
-        data = json.loads(request.body)
-        hook = Webhook.objects.create(
-                event=events[data['event']][0],
-                meeting_id=data['payload']['object']['id'],
-                data=data['payload']['object'][events[data['event']][1]],
-                raw=request.body.decode())
-        hook.save()
+        data = zoom.json_loads(request.body)
+
+        # Zoom sometimes sends the same notification more than once, so check whether we've
+        # seen it already: first in the cache (cheap), then with the unique index on dedup_key
+        key = webhook_key(data)
+        cache_key = 'zoom:webhook:%s' % key
+        if not cache.add(cache_key, True, WEBHOOK_DEDUP_TTL):
+            return HttpResponse('Webhook already received')
+
+        event = events[data['event']]
+        obj = data['payload']['object']
+
+        try:
+            with transaction.atomic():
+                # keep the local copy of the registrant list current
+                if event == 'MRC' and 'id' in obj['registrant'] and 'email' in obj['registrant']:
+                    models.save_registrant(obj['id'], zoom.clean_registrant(obj['registrant']))
+
+                if models.ATTENDEE_COUNTER and event in ('JWR', 'MRC'):
+                    # count them now, and (normally) don't keep a row per person
+                    models.count_attendee(obj['id'], obj.get('uuid', '') if event == 'JWR' else '', event, attendee_key(obj))
+                    if not models.WEBHOOK_DEBUG:
+                        return HttpResponse('Webhook received')
+
+                hook = Webhook.objects.create(
+                        event=event,
+                        meeting_id=obj['id'],
+                        payload=payloads.pack(data),
+                        dedup_key=key,
+                        attendee=attendee_key(obj)[:255])
+                hook.save()
+        except IntegrityError:
+            # only a clash on dedup_key means we've seen it before; anything else (e.g. two registrations
+            # racing to save the same registrant) is a real failure, so let Zoom's retry through
+            if Webhook.objects.filter(dedup_key=key).exists():
+                return HttpResponse('Webhook already received')
+            cache.delete(cache_key)
+            raise
+        except:
+            # we didn't actually record it, so let Zoom's retry through
+            cache.delete(cache_key)
+            raise
+
         return HttpResponse('Webhook received')
 
 # Record a click on the Start Meeting button
@@ -67,12 +175,159 @@ def start(request, meeting_id, encoded_url):
     event.save()
     return HttpResponseRedirect(urllib.parse.unquote(encoded_url))
 
-# Historical attendance records
+# Meetings per page of the attendance records, and months of totals shown above them
+ATTENDANCE_PAGE_SIZE = 100
+ATTENDANCE_MONTHS = 12
+
+# Historical attendance records, most recent first
+#
+# Query parameters:
+#   meeting_id: only this meeting (or series of meetings), with its totals
+#   before: the `next` cursor from the previous page
+#
+# Pagination is by key (time and ID of the last meeting shown), and the totals come from the rollup tables,
+# so the page costs the same no matter how much history there is
 @login_required
 @processing_time
 def attendance(request):
-    meetings = Meeting.objects.filter(title__endswith='(from events)').order_by('-time')
-    return TemplateInvocation('zoom/attendance.html', {'meetings': meetings})
+    data = {}
+    meetings = Meeting.objects.filter(kind='EV')
+
+    meeting_id = request.GET.get('meeting_id', '')
+    if meeting_id.isdigit():
+        meetings = meetings.filter(meeting_id=int(meeting_id))
+        data['series'] = SeriesAttendance.objects.filter(kind='EV', meeting_id=int(meeting_id)).first()
+        data['meeting_id'] = meeting_id
+    else:
+        data['months'] = MonthlyAttendance.objects.filter(kind='EV').order_by('-month')[:ATTENDANCE_MONTHS]
+        data['total'] = MonthlyAttendance.objects.filter(kind='EV').aggregate(meetings=Sum('meetings'))['meetings'] or 0
+
+    before = request.GET.get('before', '')
+    if before:
+        before_time, _, before_id = before.rpartition('|')
+        try:
+            before_time = datetime.fromisoformat(before_time)
+        except ValueError:
+            before_id = ''
+        if not before_id.isdigit():
+            data['error_message'] = 'Bad page link'
+            return TemplateInvocation('zoom/attendance.html', data)
+        meetings = meetings.filter(Q(time__lt=before_time) | Q(time=before_time, id__lt=int(before_id)))
+
+    page = list(meetings.order_by('-time', '-id')[:ATTENDANCE_PAGE_SIZE + 1])
+    if len(page) > ATTENDANCE_PAGE_SIZE:
+        page = page[:ATTENDANCE_PAGE_SIZE]
+        data['next'] = '%s|%d' % (page[-1].time.isoformat(), page[-1].id)
+
+    data['meetings'] = page
+    return TemplateInvocation('zoom/attendance.html', data)
+
+# Exports (CSV or JSON) of the attendance records and participant reports, for reporting
+#
+# These can cover years of history, so rows are streamed straight from a database cursor
+# (QuerySet.iterator) to the client, and memory use stays the same however big the export is.
+EXPORT_FORMATS = ('csv', 'json')
+EXPORT_CHUNK_SIZE = 2000
+
+# File-like object that just hands back what's written to it, so that csv.writer can produce one row at a time
+class Echo(object):
+    def write(self, value):
+        return value
+
+# Stream `rows` (tuples, in the order of `fields`) as a CSV or JSON file download
+def export_response(fmt, filename, fields, rows):
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+
+        def lines():
+            yield writer.writerow(fields)
+            for row in rows:
+                yield writer.writerow(row)
+
+        response = StreamingHttpResponse(lines(), content_type='text/csv')
+    else:
+        def lines():
+            yield '['
+            separator = '\n'
+            for row in rows:
+                yield separator + json.dumps(dict(zip(fields, row)))
+                separator = ',\n'
+            yield '\n]\n'
+
+        response = StreamingHttpResponse(lines(), content_type='application/json')
+
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, fmt)
+    return response
+
+# Apply the filters that all exports share to `rows`
+#   meeting_id: only this meeting (or series of meetings)
+#   from, to: only dates in this range (YYYY-MM-DD, inclusive), on `date_field`
+# Returns the filtered rows, or None if a filter is malformed
+def export_filters(request, rows, date_field):
+    meeting_id = request.GET.get('meeting_id', '')
+    if meeting_id:
+        if not meeting_id.isdigit():
+            return None
+        rows = rows.filter(meeting_id=int(meeting_id))
+
+    # (as a range of times in the site's time zone, rather than by date, so that it can use an index)
+    try:
+        if request.GET.get('from'):
+            rows = rows.filter(**{date_field + '__gte': timezone.make_aware(datetime.strptime(request.GET['from'], '%Y-%m-%d'))})
+        if request.GET.get('to'):
+            rows = rows.filter(**{date_field + '__lt': timezone.make_aware(datetime.strptime(request.GET['to'], '%Y-%m-%d') + timedelta(days=1))})
+    except ValueError:
+        return None
+
+    return rows
+
+# Attendance records
+#
+# Query parameters (besides the ones in export_filters, which apply to the meeting's date):
+#   kind: which records (see Meeting.KINDS), default 'EV' (the ones on the attendance page)
+@login_required
+def export_attendance(request, fmt):
+    kind = request.GET.get('kind', 'EV')
+    if fmt not in EXPORT_FORMATS or kind not in dict(Meeting.KINDS):
+        return HttpResponse('Bad export options', status=400)
+
+    meetings = export_filters(request, Meeting.objects.filter(kind=kind), 'time')
+    if meetings is None:
+        return HttpResponse('Bad export options', status=400)
+
+    fields = ('meeting_id', 'kind', 'title', 'time', 'duration_minutes', 'registrants', 'participants')
+    rows = meetings.order_by('time', 'id').values_list('meeting_id', 'kind', 'title', 'time', 'duration', 'registrants', 'participants')
+
+    def convert(rows):
+        for meeting_id, kind, title, time, duration, registrants, participants in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield meeting_id, kind, title, time.isoformat(), round(duration.total_seconds() / 60), registrants, participants
+
+    return export_response(fmt, 'attendance', fields, convert(rows))
+
+# Everyone in the stored participant reports (one row per person per meeting instance)
+#
+# Query parameters (besides the ones in export_filters, which apply to when the meeting instance started):
+#   uuid: only this meeting instance
+@login_required
+def export_participants(request, fmt):
+    if fmt not in EXPORT_FORMATS:
+        return HttpResponse('Bad export options', status=400)
+
+    reports = export_filters(request, ParticipantReport.objects.all(), 'start')
+    if reports is None:
+        return HttpResponse('Bad export options', status=400)
+    if request.GET.get('uuid'):
+        reports = reports.filter(meeting_uuid=request.GET['uuid'])
+
+    fields = ('meeting_id', 'meeting_uuid', 'meeting_start', 'report_fetched', 'report_final', 'name', 'email', 'duration_minutes')
+    rows = Participant.objects.filter(report__in=reports).order_by('report_id', 'name_key', 'id').values_list(
+            'report__meeting_id', 'report__meeting_uuid', 'report__start', 'report__fetched', 'report__final', 'name', 'email', 'duration')
+
+    def convert(rows):
+        for meeting_id, uuid, start, fetched, final, name, email, duration in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield meeting_id, uuid, start and start.isoformat(), fetched.isoformat(), final, name, email, round(duration, 1)
+
+    return export_response(fmt, 'participants', fields, convert(rows))
 
 # Show a list of upcoming meetings
 @login_required
@@ -80,12 +335,53 @@ def attendance(request):
 def meetings(request):
     if 'crash' in request.GET:
         raise Exception('oh no')
-    token = zoom.gen_token()
-    if 'type' in request.GET:
-        meetings, _ = zoom.list_meetings(token, typ=request.GET['type'])
-    else:
-        meetings, _ = zoom.list_meetings(token)
-    return TemplateInvocation('zoom/meetings.html', {'meetings': meetings})
+    token = zoom.tokens
+    typ = request.GET.get('type', 'upcoming')
+    # the rendered table is cached (for as long as the list itself) under the list's key (see meetings.html);
+    # get the key first, so that if the list changes in the meantime, we can't store an old table under the new key
+    key = caching.meetings_key('me', typ)
+    try:
+        meetings, _ = caching.list_meetings(token, typ=typ)
+    except zoom.Error as e:
+        return TemplateInvocation('zoom/meetings.html', {'meetings': [], 'error_message': 'Couldn\'t get the list of meetings from Zoom (%s): %s' % (e.code, e.data.get('message', e.data))})
+    return TemplateInvocation('zoom/meetings.html', {'meetings': meetings, 'meetings_key': key, 'fragment_ttl': caching.MEETINGS_TTL})
+
+# How long (seconds) after a meeting's scheduled end to wait before storing its participant report
+# (meetings often run over, and the report isn't final until the meeting has actually ended)
+PARTICIPANT_REPORT_DELAY = getattr(secrets, 'PARTICIPANT_REPORT_DELAY', 6 * 60 * 60)
+
+# How long (seconds) a participant report that isn't final yet is used before it's fetched from Zoom again
+PARTICIPANT_REFRESH = getattr(secrets, 'PARTICIPANT_REFRESH', 5 * 60)
+
+# How long (seconds) the local copy of a meeting's registrants is used before it's fully refreshed from Zoom
+# (new registrations arrive by webhook in the meantime, and zoom_sync_registrants can refresh them in the background)
+REGISTRANT_MAX_AGE = getattr(secrets, 'REGISTRANT_MAX_AGE', 24 * 60 * 60)
+
+# The registration questions for a meeting (taken from its first registrant)
+def registrant_questions(meeting_id):
+    first = Registrant.objects.filter(meeting_id=meeting_id).order_by('sort_key', 'id').first()
+    return [question['title'] for question in first.as_dict()['answers']] if first else []
+
+# Add what the meeting page shows about a meeting's registrants and participants (from our local copies)
+# That section of the page is cached, keyed on `people_version`, which changes whenever the registrants or
+# the participant report do (so the questions are only looked up when it actually gets rendered)
+def meeting_summary(data, meeting_id, meeting, report):
+    version = []
+    if meeting['settings']['approval_type'] != 2:
+        registrants = Registrant.objects.filter(meeting_id=meeting_id).aggregate(count=Count('id'), updated=Max('updated'))
+        data['registrant_count'] = registrants['count']
+        data['questions'] = lambda: registrant_questions(meeting_id)
+        version += [registrants['count'], registrants['updated'] and registrants['updated'].timestamp()]
+    if report is not None:
+        data['participant_count'] = report.participant_set.count()
+        data['meeting_uuid'] = report.meeting_uuid
+        version += [report.pk, report.fetched.timestamp()]
+
+    data['people_version'] = ':'.join(map(str, version))
+    data['fragment_ttl'] = caching.FRAGMENT_TTL
+
+    data['meeting'] = meeting
+    data['editable_settings'] = zoom.EDITABLE_SETTINGS
 
 # Show details about a single meeting
 # If method==POST, update meeting details first
@@ -94,13 +390,7 @@ def meetings(request):
 def meeting(request, meeting_id, occurrence_id=None):
     data = {}
 
-    token = zoom.gen_token()
-
-    editable_settings = [
-        ('waiting_room', 'Use waiting room', 'boolean'),
-        ('request_permission_to_unmute_participants', 'Request permission to unmute participants', 'boolean'),
-        ('mute_upon_entry', 'Mute participants on entry', 'boolean'),
-    ]
+    token = zoom.tokens
 
     try:
         meeting, _ = zoom.get_meeting(token, meeting_id, occurrence_id)
@@ -113,7 +403,7 @@ def meeting(request, meeting_id, occurrence_id=None):
             if post['action'] == 'settings':
                 updates = {'settings': {}}
 
-                for setting in editable_settings:
+                for setting in zoom.EDITABLE_SETTINGS:
                     if setting[2] == 'boolean':
                         updates['settings'][setting[0]] = setting[0] in post
 
@@ -160,6 +450,8 @@ def meeting(request, meeting_id, occurrence_id=None):
                     except zoom.Error as e:
                         code = e.code
                         error = urllib.request.quote(json.dumps(e.data))
+                    else:
+                        caching.invalidate_meetings()
 
                     return HttpResponseRedirect('?response_code=%d&error=%s' % (code, error)) # redirect so that refreshing doesn't POST again
 
@@ -179,40 +471,334 @@ def meeting(request, meeting_id, occurrence_id=None):
                         error = urllib.request.quote(json.dumps(e.data))
                         return HttpResponseRedirect('?response_code=%d&error=%s' % (code, error)) # redirect so that refreshing doesn't POST again
 
+                    caching.invalidate_meetings()
                     return redirect('meeting', meeting_id=meeting['id'])
 
         # this is now a GET request, show the meeting info
 
-        if meeting['settings']['approval_type'] == 2: # registration not required
+        # for a recurring meeting, search for a occurrence we want
+        if 'occurrences' in meeting:
+            for occurrence in meeting['occurrences']:
+                if int(occurrence['occurrence_id']) == occurrence_id:
+                    meeting.set_time(occurrence['start_time'], occurrence['duration'])
+                    break
+
+        # once we have the meeting, the registrants and attendees don't depend on each other,
+        # so fetch them at the same time
+        # (the tables themselves are filled in a page at a time by meeting_rows; this just makes
+        # sure our copies are up to date and counts them)
+        with ThreadPoolExecutor(max_workers=2) as pool:
             registrants = None
+            if meeting['settings']['approval_type'] != 2: # registration required
+                # use the local copy of the registrants if it's recent enough, otherwise refresh it from Zoom
+                if not registrants_synced(meeting_id, REGISTRANT_MAX_AGE):
+                    registrants = pool.submit(timing.in_context(zoom.get_registrants), token, meeting_id)
+
+            participants = None
+            report = None
+            try:
+                # if it's a past meeting, get attendees
+                # (by the same UUID the report is stored under, so that the report always matches its key; FIXME for a
+                # recurring meeting that's the instance Zoom gives us the UUID of, not necessarily the occurrence shown)
+                end_time = meeting.end
+                if end_time < datetime.now(pytz.utc):
+                    # past meetings' reports don't change (once they've settled), so use our copy if we have one
+                    report = participant_report(meeting.get('uuid', ''), PARTICIPANT_REFRESH)
+                    if report is None:
+                        participants = pool.submit(timing.in_context(zoom.get_participants), token, meeting['uuid'])
+            except Exception as e:
+                data['error_message'] = 'Couldn\'t fetch attendee data: %s' % e
+
+            if registrants is not None:
+                registrants, _ = registrants.result()
+                sync_registrants(meeting_id, registrants)
+
+            try:
+                if participants is not None:
+                    participants, _ = participants.result()
+
+                    # the report is incomplete while the meeting is still going, so it's only final once it's had time to settle
+                    report = save_participants(meeting['uuid'], meeting_id, participants,
+                            final=end_time + timedelta(seconds=PARTICIPANT_REPORT_DELAY) < datetime.now(pytz.utc), start=meeting.start)
+            except Exception as e:
+                data['error_message'] = 'Couldn\'t fetch attendee data: %s' % e
+
+        meeting_summary(data, meeting_id, meeting, report)
+
+    if 'response_code' in request.GET:
+        data['response_code'] = int(request.GET['response_code'])
+    if 'error' in request.GET:
+        data['error'] = zoom.load_json(request.GET['error'])
+    return TemplateInvocation('zoom/meeting.html', data)
+
+
+# Rows per page of the registrant/participant tables, by default and at most
+ROWS_PAGE_SIZE = 100
+MAX_ROWS_PAGE_SIZE = 1000
+
+# Rows of the registrant/participant tables on the meeting page, a page at a time, as JSON
+#
+# Query parameters:
+#   kind: 'registrants' (default), 'participants', or 'emails' (just every registrant's email address, for "email all")
+#   uuid: the meeting instance whose participants to use (for the attendance column of the registrants)
+#   q: only rows where the name, last name, email or location starts with this (case insensitive)
+#   after: the `next` cursor from the previous page
+#   limit: page size
+#
+# Pagination is by key (last seen sort key and ID), so every page is an index range scan no matter how deep it is
+@login_required
+@processing_time
+def meeting_rows(request, meeting_id):
+    kind = request.GET.get('kind', 'registrants')
+    query = request.GET.get('q', '').strip().lower()
+    after = request.GET.get('after', '')
+    try:
+        limit = max(1, min(int(request.GET.get('limit', ROWS_PAGE_SIZE)), MAX_ROWS_PAGE_SIZE))
+    except ValueError:
+        limit = ROWS_PAGE_SIZE
+
+    report = ParticipantReport.objects.filter(meeting_uuid=request.GET.get('uuid', ''), meeting_id=meeting_id).first()
+
+    if kind == 'emails':
+        emails = Registrant.objects.filter(meeting_id=meeting_id).order_by('sort_key', 'id').values_list('email', flat=True)
+        return JsonResponse({'emails': list(emails)})
+    elif kind == 'participants':
+        rows = Participant.objects.filter(report=report)
+        key = 'name_key'
+        search = ('name_key', 'email')
+    else:
+        rows = Registrant.objects.filter(meeting_id=meeting_id)
+        key = 'sort_key'
+        search = ('sort_key', 'name_key', 'email', 'location_key')
+
+    if query:
+        # a range rather than __startswith, so that it can use an ordinary index on any database
+        prefix = Q()
+        for field in search:
+            prefix |= Q(**{field + '__gte': query, field + '__lt': query + '\uffff'})
+        rows = rows.filter(prefix)
+
+    if after:
+        after_key, _, after_id = after.rpartition('|')
+        if not after_id.isdigit():
+            return JsonResponse({'error': 'Bad cursor'}, status=400)
+        rows = rows.filter(Q(**{key + '__gt': after_key}) | Q(**{key: after_key, 'id__gt': int(after_id)}))
+
+    page = list(rows.order_by(key, 'id')[:limit + 1])
+    more = len(page) > limit
+    page = page[:limit]
+
+    result = {'next': '%s|%d' % (getattr(page[-1], key), page[-1].id) if more else None}
+
+    if kind == 'participants':
+        result['rows'] = [{'name': p.name, 'email': p.email, 'duration': p.duration} for p in page]
+    else:
+        # attendance column: minutes in the meeting, or whether they started the meeting through this app
+        attended = {}
+        starters = []
+        if report is not None:
+            attended = dict(report.participant_set.filter(email__in=[r.email for r in page]).values_list('email', 'duration'))
+            starters = list(models.meeting_starters(meeting_id).values_list('email', 'first_name', 'last_name'))
+
+        result['rows'] = []
+        for registrant in page:
+            row = registrant.as_dict()
+            row['answers'] = [answer['value'] for answer in row['answers']]
+            if report is not None:
+                row['duration'] = attended.get(registrant.email)
+                row['host'] = any(email == registrant.email or '%s %s' % (first, last) == registrant.name for email, first, last in starters)
+            result['rows'].append(row)
+
+    return JsonResponse(result)
+
+# Change settings on many meetings at once (staff only)
+# GET shows the meetings matching the filters; POST applies the chosen settings to them
+@login_required
+@user_passes_test(lambda user: user.is_staff)
+@processing_time
+def bulk_settings(request):
+    params = request.POST if request.method == 'POST' else request.GET
+    data = {
+            'editable_settings': zoom.EDITABLE_SETTINGS,
+            'type': params.get('type', 'upcoming'),
+            'topic': params.get('topic', ''),
+            'start': params.get('start', ''),
+            'end': params.get('end', ''),
+        }
+
+    try:
+        start = datetime.strptime(data['start'], '%Y-%m-%d') if data['start'] else None
+        end = datetime.strptime(data['end'], '%Y-%m-%d') if data['end'] else None
+    except ValueError:
+        data['error_message'] = 'Dates should look like YYYY-MM-DD'
+        return TemplateInvocation('zoom/bulk_settings.html', data)
+
+    try:
+        meetings, _ = caching.list_meetings(zoom.tokens, typ=data['type'])
+    except zoom.Error as e:
+        data['error_message'] = 'Couldn\'t get the list of meetings from Zoom (%s): %s' % (e.code, e.data.get('message', e.data))
+        return TemplateInvocation('zoom/bulk_settings.html', data)
+
+    data['meetings'] = bulk.select_meetings(meetings, data['topic'], start, end)
+
+    if request.method == 'POST':
+        # each setting is 'on', 'off' or left alone (missing/empty)
+        values = {setting[0]: params[setting[0]] == 'on' for setting in zoom.EDITABLE_SETTINGS if params.get(setting[0]) in ('on', 'off')}
+        if not values:
+            data['error_message'] = 'Choose at least one setting to change'
         else:
-            registrants, _ = zoom.get_registrants(token, meeting_id)
+            data['results'] = bulk.apply_updates(request.user, data['meetings'], bulk.settings_updates(values))
+            data['changed'] = sum(1 for result in data['results'] if result.ok)
+            data['failed'] = len(data['results']) - data['changed']
+
+    return TemplateInvocation('zoom/bulk_settings.html', data)
+
+# Async views
+#
+# Under ASGI, with ASYNC_VIEWS set, the meeting list and meeting pages are served by these instead
+# (see urls.py). They make their Zoom API calls with zoom_api_async, so a page waiting on Zoom doesn't
+# tie up a worker thread, and a single process can serve many more people at once. Database work and
+# template rendering still happen in Django's sync thread (see run_sync).
+ASYNC_VIEWS = getattr(secrets, 'ASYNC_VIEWS', False)
+
+# Run database code (or anything else synchronous) from an async view, counting its queries into the current trace
+async def run_sync(fn, *args, **kwargs):
+    trace = timing.current_trace()
+
+    def run():
+        if trace is None:
+            return fn(*args, **kwargs)
+        with connection.execute_wrapper(timing.QueryTimer(trace)):
+            return fn(*args, **kwargs)
+
+    return await sync_to_async(run)()
+
+# login_required, for async views
+def async_login_required(view):
+    async def checked_view(request, *args, **kwargs):
+        if not await run_sync(lambda: request.user.is_authenticated):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+
+    return checked_view
+
+# processing_time, for async views
+def async_processing_time(view):
+    async def timed_view(request, *args, **kwargs):
+        start = datetime.now()
+        trace, token = timing.start_trace()
+
+        try:
+            result = await view(request, *args, **kwargs)
+
+            if isinstance(result, TemplateInvocation):
+                result.data['processing_time'] = (datetime.now() - start)
+
+                render_start = time.perf_counter()
+                response = await run_sync(render, request, result.filename, result.data)
+                trace.template_time = time.perf_counter() - render_start
+            else:
+                response = result
+        finally:
+            timing.end_trace(token)
 
+        report_timing(trace, view, request, response)
+        return response
+
+    return timed_view
+
+# Async version of `meetings`
+@async_login_required
+@async_processing_time
+async def meetings_async(request):
+    token = zoom.tokens
+    typ = request.GET.get('type', 'upcoming')
+    key = await sync_to_async(caching.meetings_key)('me', typ)
+    try:
+        meetings, _ = await caching.alist_meetings(token, typ=typ)
+    except zoom.Error as e:
+        return TemplateInvocation('zoom/meetings.html', {'meetings': [], 'error_message': 'Couldn\'t get the list of meetings from Zoom (%s): %s' % (e.code, e.data.get('message', e.data))})
+    return TemplateInvocation('zoom/meetings.html', {'meetings': meetings, 'meetings_key': key, 'fragment_ttl': caching.MEETINGS_TTL})
+
+# Async version of `meeting`
+# Edits (POSTs) are rare, so they're still handled by `meeting` itself (in a thread)
+async def meeting_async(request, meeting_id, occurrence_id=None):
+    if request.method == 'POST':
+        return await sync_to_async(meeting)(request, meeting_id, occurrence_id)
+    return await meeting_page_async(request, meeting_id, occurrence_id)
+
+@async_login_required
+@async_processing_time
+async def meeting_page_async(request, meeting_id, occurrence_id=None):
+    data = {}
+
+    token = zoom.tokens
+
+    try:
+        meeting, _ = await zoom_async.get_meeting(token, meeting_id, occurrence_id)
+    except zoom.Error as e:
+        data['response_code'] = e.code
+        data['response_data'] = e.data
+    else:
         # for a recurring meeting, search for a occurrence we want
         if 'occurrences' in meeting:
             for occurrence in meeting['occurrences']:
                 if int(occurrence['occurrence_id']) == occurrence_id:
-                    meeting['start_time'] = occurrence['start_time']
-                    meeting['duration'] = occurrence['duration']
+                    meeting.set_time(occurrence['start_time'], occurrence['duration'])
                     break
 
-        data['meeting'] = meeting
-        data['registrants'] = registrants
-        data['editable_settings'] = editable_settings
+        # see which of our local copies are missing or out of date, then fetch those from Zoom at the same time
+        fetch_registrants = meeting['settings']['approval_type'] != 2 and not await run_sync(registrants_synced, meeting_id, REGISTRANT_MAX_AGE)
 
+        fetch_participants = False
+        report = None
         try:
-            # if it's a past meeting, get attendees (FIXME won't work for recurring meetings)
-            if pytz.utc.localize(datetime.strptime(meeting['start_time'], '%Y-%m-%dT%H:%M:%SZ')) + timedelta(minutes=int(meeting['duration'])) < datetime.now(pytz.utc):
-                data['participants'], _ = zoom.get_participants(token, meeting_id)
-
-                # also get users who started this meeting
-                data['starters'] = User.objects.filter(event__meeting_id=meeting_id, event__event='ST')
+            end_time = meeting.end
+            if end_time < datetime.now(pytz.utc):
+                report = await run_sync(participant_report, meeting.get('uuid', ''), PARTICIPANT_REFRESH)
+                fetch_participants = report is None
         except Exception as e:
             data['error_message'] = 'Couldn\'t fetch attendee data: %s' % e
 
+        async def get_registrants():
+            if fetch_registrants:
+                registrants, _ = await zoom_async.get_registrants(token, meeting_id)
+                return registrants
+
+        async def get_participants():
+            if fetch_participants:
+                try:
+                    participants, _ = await zoom_async.get_participants(token, meeting['uuid'])
+                    return participants
+                except Exception as e:
+                    data['error_message'] = 'Couldn\'t fetch attendee data: %s' % e
+
+        registrants, participants = await asyncio.gather(get_registrants(), get_participants())
+
+        def save():
+            nonlocal report
+            if registrants is not None:
+                sync_registrants(meeting_id, registrants)
+
+            try:
+                if participants is not None:
+                    report = save_participants(meeting['uuid'], meeting_id, participants,
+                            final=end_time + timedelta(seconds=PARTICIPANT_REPORT_DELAY) < datetime.now(pytz.utc), start=meeting.start)
+            except Exception as e:
+                data['error_message'] = 'Couldn\'t fetch attendee data: %s' % e
+
+            meeting_summary(data, meeting_id, meeting, report)
+
+        await run_sync(save)
+
     if 'response_code' in request.GET:
         data['response_code'] = int(request.GET['response_code'])
     if 'error' in request.GET:
         data['error'] = zoom.load_json(request.GET['error'])
     return TemplateInvocation('zoom/meeting.html', data)
 
+# Rolling latency percentiles per Zoom API endpoint, for this worker process (JSON)
+@login_required
+@user_passes_test(lambda user: user.is_staff)
+def timing_stats(request):
+    return JsonResponse(timing.stats.summary())
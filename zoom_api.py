@@ -1,32 +1,94 @@
 from zoom import secrets
+from zoom import ratelimit
+from zoom import timing
 
 from authlib.jose import jwt
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import threading
 import time
+import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from sortedcontainers import SortedList
+from xml.parsers.expat import ExpatError
 import xmltodict
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 API_BASE = 'https://api.zoom.us/v2'
 MAX_PAGE_SIZE = 300
 
+# (connect, read) timeouts in seconds, so that a slow Zoom response can't tie up a worker forever
+TIMEOUT = getattr(secrets, 'ZOOM_TIMEOUT', (5, 30))
+
+# Number of keep-alive connections to api.zoom.us kept open per process
+POOL_SIZE = getattr(secrets, 'ZOOM_POOL_SIZE', 10)
+
+# How many times to retry a request that was rate limited (HTTP 429), and the longest we're
+# willing to sleep before a retry -- if Zoom asks us to wait longer than that (e.g. because
+# the daily limit was hit), give up right away instead of pinning the worker
+MAX_RETRIES = getattr(secrets, 'ZOOM_MAX_RETRIES', 3)
+MAX_RETRY_WAIT = getattr(secrets, 'ZOOM_MAX_RETRY_WAIT', 10)
+
+# Maximum number of Zoom API requests a single call (e.g. list_meetings) will have in flight at once
+MAX_CONCURRENCY = getattr(secrets, 'ZOOM_MAX_CONCURRENCY', 8)
+
+# Participant reports with at least this many records are merged with NumPy (if it's installed)
+NUMPY_THRESHOLD = getattr(secrets, 'PARTICIPANTS_NUMPY_THRESHOLD', 10000)
+
+# Use orjson for API responses and webhooks, if it's installed
+FAST_JSON = getattr(secrets, 'FAST_JSON', True)
+
+# How long each cached JWT is valid for, and how long before expiry it gets re-signed
+TOKEN_DURATION = getattr(secrets, 'JWT_TOKEN_DURATION', 600)
+TOKEN_REFRESH_MARGIN = getattr(secrets, 'JWT_TOKEN_REFRESH_MARGIN', 60)
+
 class Error(Exception):
     def __init__(self, code, data):
         self.code = code
         self.data = data
 
-def load_json(text):
-    try:
-        return json.loads(text)
-    except:
-        pass
-
-    try:
-        return xmltodict.parse(text)
-    except:
-        pass
-
+# Parse JSON (str or bytes), with orjson if it's installed and enabled (it's several times faster)
+def json_loads(text):
+    if orjson is not None and FAST_JSON:
+        return orjson.loads(text)
+    return json.loads(text)
+
+# Serialize to compact JSON (bytes), with orjson if it's installed and enabled
+def json_dumps(data):
+    if orjson is not None and FAST_JSON:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+# Parse an API response body (str or bytes), based on its Content-Type if we know it
+# Anything that isn't JSON or XML (or doesn't parse) comes back as {'text': body}
+def load_json(text, content_type=None):
+    content_type = (content_type or '').lower()
+
+    if not content_type or 'json' in content_type:
+        try:
+            return json_loads(text)
+        except ValueError:
+            pass
+
+    if not content_type or 'xml' in content_type:
+        try:
+            return xmltodict.parse(text)
+        except ExpatError:
+            pass
+
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', 'replace')
     return {'text': text}
 
 # Generate a JWT token valid for the next `duration` seconds
@@ -40,26 +102,142 @@ def gen_token(duration=30):
 
     return jwt.encode(header, payload, secrets.JWT_SECRET)
 
+# Process-wide JWT cache
+# Pass this in place of a token, and each request will pick up the current token (re-signed shortly
+# before it expires), so long-running loops over the API never end up using an expired one
+class TokenCache(object):
+    def __init__(self, duration=TOKEN_DURATION, margin=TOKEN_REFRESH_MARGIN):
+        self.duration = duration
+        self.margin = margin
+        self.expires = 0
+        self.header = None
+        self.lock = threading.Lock()
+
+    # Returns the Authorization header value for a token that is good for at least `margin` more seconds
+    def authorization(self):
+        if time.time() >= self.expires - self.margin:
+            with self.lock:
+                now = time.time()
+                if now >= self.expires - self.margin:
+                    self.header = 'Bearer %s' % gen_token(self.duration).decode('utf-8')
+                    self.expires = now + self.duration
+
+        return self.header
+
+tokens = TokenCache()
+
+# Shared connection pool for all Zoom API traffic in this process
+# (requests.Session is safe to share between threads as long as nobody mutates it)
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+
+    return _session
+
+# How long to wait before retrying a rate-limited response
+# Uses the Retry-After header if Zoom sent one (either seconds or an HTTP date), otherwise exponential backoff
+def retry_delay(rep, attempt):
+    retry_after = rep.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return int(retry_after)
+    if retry_after:
+        try:
+            when = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            pass
+        else:
+            return max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+    return min(MAX_RETRY_WAIT, 0.5 * 2 ** attempt)
+
 # Perform a Zoom API request
 # Returns the response as a JSON object
 def zoom_request(token, path, params={}, method='GET'):
-    headers = {'Authorization': 'Bearer %s' % token.decode('utf-8')}
+    if isinstance(token, TokenCache):
+        headers = {'Authorization': token.authorization()}
+    else:
+        headers = {'Authorization': 'Bearer %s' % token.decode('utf-8')}
+    url = '%s/%s' % (API_BASE, path)
 
     if method == 'GET':
-        rep = requests.get('%s/%s' % (API_BASE, path), headers=headers, params=params)
-
-    if method == 'POST':
+        kwargs = {'params': params}
+    else:
         headers['Content-Type'] = 'application/json'
-        rep = requests.post('%s/%s' % (API_BASE, path), headers=headers, data=json.dumps(params))
+        kwargs = {'data': json.dumps(params)}
+
+    session = get_session()
+    start = time.perf_counter()
+    for attempt in range(MAX_RETRIES + 1):
+        # wait our turn, so that all of our processes together stay under Zoom's rate limits
+        try:
+            ratelimit.acquire(method, path)
+        except ratelimit.RateLimited as e:
+            raise Error(429, {'message': 'Too many requests to Zoom right now, try again in %d seconds' % max(1, round(e.wait))})
+
+        try:
+            rep = session.request(method, url, headers=headers, timeout=TIMEOUT, **kwargs)
+        except requests.Timeout:
+            timing.record_call(path, method, 504, 0, time.perf_counter() - start)
+            raise Error(504, {'message': 'Timed out waiting for Zoom'})
+        except requests.ConnectionError as e:
+            timing.record_call(path, method, 502, 0, time.perf_counter() - start)
+            raise Error(502, {'message': 'Could not connect to Zoom: %s' % e})
+
+        if rep.status_code != 429 or attempt == MAX_RETRIES:
+            break
 
-    if method == 'PATCH':
-        headers['Content-Type'] = 'application/json'
-        rep = requests.patch('%s/%s' % (API_BASE, path), headers=headers, data=json.dumps(params))
+        ratelimit.throttle(method, path)
+
+        delay = retry_delay(rep, attempt)
+        if delay > MAX_RETRY_WAIT:
+            break
+        time.sleep(delay)
+
+    timing.record_call(path, method, rep.status_code, len(rep.content), time.perf_counter() - start)
 
+    body = load_json(rep.content, rep.headers.get('Content-Type'))
     if 200 <= rep.status_code < 300:
-        return load_json(rep.text), rep.status_code
+        return body, rep.status_code
 
-    raise Error(rep.status_code, load_json(rep.text))
+    raise Error(rep.status_code, body)
+
+# A meeting from the API: the JSON object as a dict, with its times parsed once up front
+# `start` is an aware UTC datetime (None for meetings with no fixed time) and `end` is start + duration
+class MeetingRecord(dict):
+    __slots__ = ('start', 'end')
+
+    def __init__(self, data, start=None, end=None):
+        super().__init__(data)
+        if start is None and 'start_time' in self:
+            self.parse_times()
+        else:
+            self.start = start
+            self.end = end
+
+    def parse_times(self):
+        self.start = parse_time(self['start_time']).replace(tzinfo=timezone.utc)
+        self.end = self.start + timedelta(minutes=int(self['duration'])) if self.get('duration') is not None else None
+
+    # Change the start time (in Zoom's format) and duration, e.g. to show one occurrence of a recurring meeting
+    def set_time(self, start_time, duration):
+        self['start_time'] = start_time
+        self['duration'] = duration
+        self.parse_times()
+
+    # Keep the parsed times when pickled (e.g. in a cached meeting list), rather than parsing them again
+    def __reduce__(self):
+        return (MeetingRecord, (dict(self), getattr(self, 'start', None), getattr(self, 'end', None)))
 
 # List upcoming meetings
 def list_meetings(token, user='me', typ='upcoming', follow_recurring=True):
@@ -71,7 +249,7 @@ def list_meetings(token, user='me', typ='upcoming', follow_recurring=True):
         if code != 200:
             break
 
-        meetings += sorted(data['meetings'], key=lambda m: m['start_time'])
+        meetings += sorted(map(MeetingRecord, data['meetings']), key=lambda m: m['start_time'])
 
         if 'next_page_token' in data and data['next_page_token'] != '':
             params['next_page_token'] = data['next_page_token']
@@ -83,21 +261,28 @@ def list_meetings(token, user='me', typ='upcoming', follow_recurring=True):
         # occurrence ID. *Usually*, it's just the start time as UNIX timestamp x1000, but
         # if the individual recurrence is edited, that breaks down. So we have to make extra
         # requests to get the occurrence IDs, and we can match them up by start time.
-        cache = {}
-
-        for m in reversed(meetings): # iterate backwards to allow deletion
+        # Those requests are independent, so make them concurrently (one per series).
+        series_ids = list(dict.fromkeys(m['id'] for m in meetings if m['type'] == 8))
+        occurrences = {}
+
+        if series_ids:
+            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(series_ids))) as pool:
+                for series_id, (series, _) in zip(series_ids, pool.map(timing.in_context(lambda i: get_meeting(token, i)), series_ids)):
+                    # key assumption: start_time is an acceptable primary key
+                    # (setdefault, so that the first occurrence wins if two share a start time)
+                    by_start = occurrences[series_id] = {}
+                    for occ in series['occurrences']:
+                        by_start.setdefault(occ['start_time'], occ['occurrence_id'])
+
+        filtered = []
+        for m in meetings:
             if m['type'] == 8:
-                if m['id'] not in cache:
-                    cache[m['id']], _ = get_meeting(token, m['id'])
-
-                # key assumption: start_time is an acceptable primary key
-                for occ in cache[m['id']]['occurrences']:
-                    if occ['start_time'] == m['start_time']:
-                        m['occurrence_id'] = occ['occurrence_id']
-                        break
-                else:
+                if m['start_time'] not in occurrences[m['id']]:
                     # if we didn't find it, we can't link to the meeting page. so just leave it out???
-                    meetings.remove(m)
+                    continue
+                m['occurrence_id'] = occurrences[m['id']][m['start_time']]
+            filtered.append(m)
+        meetings = filtered
 
     return meetings, code
 
@@ -105,9 +290,17 @@ def list_meetings(token, user='me', typ='upcoming', follow_recurring=True):
 # Includes start URL but not registrants
 def get_meeting(token, meeting_id, occurrence=None):
     if occurrence is None:
-        return zoom_request(token, 'meetings/%d' % meeting_id)
+        meeting, code = zoom_request(token, 'meetings/%d' % meeting_id)
     else:
-        return zoom_request(token, 'meetings/%d' % meeting_id, params={'occurrence_id': occurrence})
+        meeting, code = zoom_request(token, 'meetings/%d' % meeting_id, params={'occurrence_id': occurrence})
+    return MeetingRecord(meeting), code
+
+# Meeting settings that can be changed from here: (name, label, type)
+EDITABLE_SETTINGS = [
+    ('waiting_room', 'Use waiting room', 'boolean'),
+    ('request_permission_to_unmute_participants', 'Request permission to unmute participants', 'boolean'),
+    ('mute_upon_entry', 'Mute participants on entry', 'boolean'),
+]
 
 # Updates a meeting
 def update_meeting(token, meeting_id, updates):
@@ -118,84 +311,199 @@ def update_meeting(token, meeting_id, updates):
 def create_meeting(token, meeting, user='me'):
     return zoom_request(token, 'users/%s/meetings' % user, params=meeting, method='POST')
 
+# Sometimes people put their full name in the "First name" box, so r['last_name'] might not exist.
+# For a best-effort (but by no means foolproof) sort by last name, we join whatever was entered in
+# the first and last name boxes, then take the final space-delimited word as the last name.
+# Similar data cleaning is performed on the location fields.
+
+# A cleaned-up registrant: id, name, email, location and answers, plus its `sort_key` (worked out once)
+class RegistrantRecord(dict):
+    __slots__ = ('sort_key',)
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.sort_key = registrant_sort_key(self['name'])
+
+    def __reduce__(self):
+        return (RegistrantRecord, (dict(self),))
+
+# Clean up a registrant record from the API (or a registration webhook)
+def clean_registrant(r):
+    def combine(row, *fields):
+        return filter(lambda x: x, map(lambda f: row.get(f, None), fields))
+
+    return RegistrantRecord({
+            'id': r['id'],
+            'name': ' '.join(combine(r, 'first_name', 'last_name')),
+            'email': r['email'].lower(),
+            'location': ', '.join(combine(r, 'city', 'state', 'country')) or 'Unknown',
+            'answers': r.get('custom_questions', []),
+        })
+
+# Key for sorting registrants by last name
+def registrant_sort_key(name):
+    return name.split(' ')[-1].lower()
+
 # Get registrants for a specific meeting
 # Returns name, email, location (if given) and answers to the questions (if any)
 # Sorts by last name
 #
 # TODO: support recurring meetings by passing the occurence_id param
 def get_registrants(token, meeting_id):
-    data, code = zoom_request(token, 'meetings/%d/registrants' % meeting_id, params={'page_size': MAX_PAGE_SIZE})
+    regs = []
+    for data, code in iter_pages(token, 'meetings/%d/registrants' % meeting_id):
+        regs.extend(map(clean_registrant, data['registrants']))
+    regs.sort(key=lambda r: r.sort_key)
 
-    # Sometimes people put their full name in the "First name" box, so r['last_name'] might not exist.
-    # For a best-effort (but by no means foolproof) sort by last name, we join whatever was entered in
-    # the first and last name boxes, then take the final space-delimited word as the last name.
-    # Similar data cleaning is performed on the location fields.
+    return regs, code
 
-    def combine(row, *fields):
-        return filter(lambda x: x, map(lambda f: row.get(f, None), fields))
+# Yield each page of a paged list endpoint, following next_page_token, along with its status code
+def iter_pages(token, path, params={}):
+    params = dict(params, page_size=MAX_PAGE_SIZE)
 
-    regs = list(
-            map(lambda r: {
-                    'id': r['id'],
-                    'name': ' '.join(combine(r, 'first_name', 'last_name')),
-                    'email': r['email'].lower(),
-                    'location': ', '.join(combine(r, 'city', 'state', 'country')) or 'Unknown',
-                    'answers': r['custom_questions'],
-                },
-                data['registrants']))
-    regs.sort(key=lambda r: r['name'].split(' ')[-1].lower())
+    while True:
+        data, code = zoom_request(token, path, params)
+        yield data, code
 
-    return regs, code
+        if data.get('next_page_token'):
+            params['next_page_token'] = data['next_page_token']
+        else:
+            break
 
-# Get list of people who actually attended a specific meeting (must be in the past)
-#
-# Returns names, emails, and total minutes in the meeting
-#
-# NB: for a recurring meeting you must pass its UUID instead of ID, or you'll always get the most recent occurrence
-def get_participants(token, meeting_id):
-    # Totals the duration of a set of time intervals,
-    # but without double-counting overlaps.
-    #
-    # Ported from the following Haskell (thanks, Antal):
-    # unionSorted :: Ord a => [(a,a)] -> [(a,a)]
-    # unionSorted [] = []
-    # unionSorted [interval] = [interval]
-    # unionSorted ((start1,end1):(start2,end2):intervals)
-    #   | start2 <= end1 = unionSorted $ ((start1, end1 `max` end2) : intervals)
-    #   | otherwise      = (start1,end1) : unionSorted ((start2,end2) : intervals)
-    def union_sorted(intervals):
-        if len(intervals) <= 1:
-            return intervals
-
-        a = intervals[0]
-        b = intervals[1]
-
-        if b[0] <= a[1]:
-            return union_sorted([(a[0], max(a[1], b[1]))] + intervals[2:])
-
-        return [a] + union_sorted(intervals[1:])
-
-    data, code = zoom_request(token, 'report/meetings/%d/participants' % meeting_id, params={'page_size': MAX_PAGE_SIZE})
-
-    # merge records using email as primary key
+# Parse a timestamp in Zoom's format (e.g. 2020-05-01T18:30:00Z) into a naive UTC datetime
+# (fromisoformat is much faster than strptime, which matters for reports with thousands of rows)
+def parse_time(s):
+    return datetime.fromisoformat(s[:-1] if s.endswith('Z') else s)
+
+# Totals the duration (in minutes) of a set of time intervals, but without double-counting overlaps
+# The intervals must be sorted by start time; overlapping/touching ones are merged in a single sweep
+def merged_minutes(intervals):
+    total = 0
+    current_start = current_end = None
+
+    for start, end in intervals:
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += (current_end - current_start).total_seconds()
+            current_start, current_end = start, end
+        elif end > current_end:
+            current_end = end
+
+    if current_end is not None:
+        total += (current_end - current_start).total_seconds()
+
+    return total / 60
+
+# Same as merged_minutes, but for everyone at once using NumPy
+# `groups` says which person each (start, end) pair belongs to (0..n-1), times are integer seconds
+def merged_minutes_numpy(groups, starts, ends, n):
+    # shift each person's intervals into their own disjoint range of the number line, so that a
+    # single sort and sweep over everything can never merge two different people's intervals
+    base = starts.min()
+    span = ends.max() - base + 1
+    starts = starts - base + groups * span
+    ends = ends - base + groups * span
+
+    order = numpy.argsort(starts, kind='stable')
+    starts, ends, groups = starts[order], ends[order], groups[order]
+
+    # an interval starts a new merged block if it begins after everything before it has ended
+    reach = numpy.maximum.accumulate(ends)
+    new_block = numpy.empty(len(starts), dtype=bool)
+    new_block[0] = True
+    new_block[1:] = starts[1:] > reach[:-1]
+
+    first = numpy.flatnonzero(new_block)
+    block_ends = numpy.maximum.reduceat(ends, first)
+
+    totals = numpy.zeros(n)
+    numpy.add.at(totals, groups[first], block_ends - starts[first])
+    return totals / 60
+
+# Combine raw participant report records into one entry per person (using email as primary key),
+# with the total minutes they were in the meeting
+# Uses NumPy for big reports, if it's installed (pass use_numpy to force one way or the other)
+def summarize_participants(records, use_numpy=None):
     people = {}
-    for record in data['participants']:
+    groups = []
+    joins = []
+    leaves = []
+
+    for record in records:
         email = record['user_email'].lower()
         if email == '':
             # not sure why this happens...
             continue
 
         if email not in people:
-            people[email] = {'name': record['name'], 'intervals': SortedList()}
+            people[email] = {'name': record['name']}
+        groups.append(email)
+        joins.append(record['join_time'])
+        leaves.append(record['leave_time'])
+
+    if not groups:
+        return people
+
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(groups) >= NUMPY_THRESHOLD
+
+    if use_numpy:
+        index = {email: i for i, email in enumerate(people)}
+        durations = merged_minutes_numpy(
+                numpy.array([index[email] for email in groups], dtype='int64'),
+                numpy.array([t.rstrip('Z') for t in joins], dtype='datetime64[s]').astype('int64'),
+                numpy.array([t.rstrip('Z') for t in leaves], dtype='datetime64[s]').astype('int64'),
+                len(people))
+        for email, duration in zip(people, durations):
+            people[email]['duration'] = float(duration)
+    else:
+        intervals = {email: [] for email in people}
+        for email, join, leave in zip(groups, joins, leaves):
+            intervals[email].append((parse_time(join), parse_time(leave)))
+        for email in people:
+            people[email]['duration'] = merged_minutes(sorted(intervals[email]))
 
-        # first pass: collect intervals in sorted order
-        people[email]['intervals'].add(tuple(map(lambda s: datetime.strptime(record[s + '_time'], '%Y-%m-%dT%H:%M:%SZ'), ('join', 'leave'))))
+    return people
+
+# Get list of people who actually attended a specific meeting (must be in the past)
+#
+# Returns names, emails, and total minutes in the meeting
+#
+# NB: for a recurring meeting you must pass its UUID instead of ID, or you'll always get the most recent occurrence
+def get_participants(token, meeting_id):
+    code = None
 
-    # second pass: combine intervals to avoid double-counting
-    for email in people.keys():
-        intervals = list(people[email]['intervals']) # extract list from SortedList
-        del people[email]['intervals']
-        people[email]['duration'] = sum(map(lambda iv: (iv[1] - iv[0]).total_seconds() / 60, union_sorted(intervals)))
+    def records():
+        nonlocal code
+        for data, code in iter_pages(token, 'report/meetings/%s/participants' % meeting_ref(meeting_id)):
+            yield from data['participants']
 
+    people = summarize_participants(records())
     return people, code
 
+# A meeting ID or instance UUID, for use in an API path
+# UUIDs can contain slashes; Zoom wants them encoded, and encoded twice if they start with / or contain //
+def meeting_ref(meeting):
+    if isinstance(meeting, int):
+        return str(meeting)
+    ref = urllib.parse.quote(meeting, safe='')
+    if meeting.startswith('/') or '//' in meeting:
+        ref = urllib.parse.quote(ref, safe='')
+    return ref
+
+# List the instances of past meetings that took place between two dates (inclusive), oldest first
+# Zoom only reports on up to a month at a time, so longer ranges are requested a month at a time
+# Returns [{'uuid', 'id', 'topic', 'start_time', 'end_time', 'duration', 'participants_count', ...}]
+def list_past_meetings(token, start, end, user='me'):
+    instances = []
+    while start <= end:
+        chunk_end = min(end, start + timedelta(days=29))
+        params = {'from': start.strftime('%Y-%m-%d'), 'to': chunk_end.strftime('%Y-%m-%d'), 'type': 'past'}
+        for data, _ in iter_pages(token, 'report/users/%s/meetings' % user, params):
+            instances.extend(data['meetings'])
+        start = chunk_end + timedelta(days=1)
+
+    # the same instance can show up in two chunks if it ran over midnight at the boundary
+    instances = list({instance['uuid']: instance for instance in instances}.values())
+    instances.sort(key=lambda instance: instance['start_time'])
+    return instances
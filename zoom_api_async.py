@@ -0,0 +1,172 @@
+from zoom import ratelimit
+from zoom import timing
+from zoom import zoom_api as zoom
+
+import asyncio
+import json
+import time
+import weakref
+
+import httpx
+
+# Async versions of the read-only zoom_api calls, for the async views (see ASYNC_VIEWS)
+#
+# Same arguments, return values and errors (zoom_api.Error) as their zoom_api counterparts, and
+# the same pooling, timeouts, retries and rate limiting, but an in-flight request only costs a
+# suspended coroutine instead of a whole worker thread.
+
+# One client (connection pool) per event loop, since they can't be shared between loops
+# Each one is closed when its loop shuts down (see _close_with_loop), which matters under WSGI, where
+# async_to_sync runs every call in a new loop
+_clients = weakref.WeakKeyDictionary()
+
+# Close a client when the running loop shuts down
+# There's no hook for that as such, but asyncio.run (which async_to_sync and ASGI servers use) finalizes
+# the loop's unfinished async generators before closing it, so this is one that waits to be finalized
+async def _close_with_loop(client):
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+async def get_client():
+    loop = asyncio.get_running_loop()
+    client, _ = _clients.get(loop, (None, None))
+
+    if client is None:
+        connect, read = zoom.TIMEOUT if isinstance(zoom.TIMEOUT, tuple) else (zoom.TIMEOUT, zoom.TIMEOUT)
+        client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_keepalive_connections=zoom.POOL_SIZE))
+
+        # start it (which registers it with the loop), and keep a reference so it isn't finalized any sooner
+        closer = _close_with_loop(client)
+        await closer.asend(None)
+        _clients[loop] = (client, closer)
+
+    return client
+
+# Perform a Zoom API request
+# Returns the response as a JSON object
+async def zoom_request(token, path, params={}, method='GET'):
+    if isinstance(token, zoom.TokenCache):
+        headers = {'Authorization': token.authorization()}
+    else:
+        headers = {'Authorization': 'Bearer %s' % token.decode('utf-8')}
+    url = '%s/%s' % (zoom.API_BASE, path)
+
+    if method == 'GET':
+        kwargs = {'params': params}
+    else:
+        headers['Content-Type'] = 'application/json'
+        kwargs = {'content': json.dumps(params)}
+
+    client = await get_client()
+    start = time.perf_counter()
+    for attempt in range(zoom.MAX_RETRIES + 1):
+        try:
+            await ratelimit.acquire_async(method, path)
+        except ratelimit.RateLimited as e:
+            raise zoom.Error(429, {'message': 'Too many requests to Zoom right now, try again in %d seconds' % max(1, round(e.wait))})
+
+        try:
+            rep = await client.request(method, url, headers=headers, **kwargs)
+        except httpx.TimeoutException:
+            timing.record_call(path, method, 504, 0, time.perf_counter() - start)
+            raise zoom.Error(504, {'message': 'Timed out waiting for Zoom'})
+        except httpx.TransportError as e:
+            timing.record_call(path, method, 502, 0, time.perf_counter() - start)
+            raise zoom.Error(502, {'message': 'Could not connect to Zoom: %s' % e})
+
+        if rep.status_code != 429 or attempt == zoom.MAX_RETRIES:
+            break
+
+        await ratelimit.throttle_async(method, path)
+
+        delay = zoom.retry_delay(rep, attempt)
+        if delay > zoom.MAX_RETRY_WAIT:
+            break
+        await asyncio.sleep(delay)
+
+    timing.record_call(path, method, rep.status_code, len(rep.content), time.perf_counter() - start)
+
+    body = zoom.load_json(rep.content, rep.headers.get('Content-Type'))
+    if 200 <= rep.status_code < 300:
+        return body, rep.status_code
+
+    raise zoom.Error(rep.status_code, body)
+
+# Yield each page of a paged list endpoint, following next_page_token, along with its status code
+async def iter_pages(token, path, params={}):
+    params = dict(params, page_size=zoom.MAX_PAGE_SIZE)
+
+    while True:
+        data, code = await zoom_request(token, path, params)
+        yield data, code
+
+        if data.get('next_page_token'):
+            params['next_page_token'] = data['next_page_token']
+        else:
+            break
+
+# List upcoming meetings (see zoom_api.list_meetings)
+async def list_meetings(token, user='me', typ='upcoming', follow_recurring=True):
+    meetings = []
+    async for data, code in iter_pages(token, 'users/%s/meetings' % user, {'type': typ}):
+        if code != 200:
+            break
+        meetings += sorted(map(zoom.MeetingRecord, data['meetings']), key=lambda m: m['start_time'])
+
+    if follow_recurring:
+        # look up every series' occurrence IDs at once (but no more than MAX_CONCURRENCY at a time)
+        series_ids = list(dict.fromkeys(m['id'] for m in meetings if m['type'] == 8))
+        limit = asyncio.Semaphore(zoom.MAX_CONCURRENCY)
+
+        async def get_series(series_id):
+            async with limit:
+                series, _ = await get_meeting(token, series_id)
+            return series
+
+        occurrences = {}
+        for series_id, series in zip(series_ids, await asyncio.gather(*map(get_series, series_ids))):
+            by_start = occurrences[series_id] = {}
+            for occ in series['occurrences']:
+                by_start.setdefault(occ['start_time'], occ['occurrence_id'])
+
+        filtered = []
+        for m in meetings:
+            if m['type'] == 8:
+                if m['start_time'] not in occurrences[m['id']]:
+                    continue
+                m['occurrence_id'] = occurrences[m['id']][m['start_time']]
+            filtered.append(m)
+        meetings = filtered
+
+    return meetings, code
+
+# Get details about a specific meeting
+async def get_meeting(token, meeting_id, occurrence=None):
+    if occurrence is None:
+        meeting, code = await zoom_request(token, 'meetings/%d' % meeting_id)
+    else:
+        meeting, code = await zoom_request(token, 'meetings/%d' % meeting_id, params={'occurrence_id': occurrence})
+    return zoom.MeetingRecord(meeting), code
+
+# Get registrants for a specific meeting, sorted by last name (see zoom_api.get_registrants)
+async def get_registrants(token, meeting_id):
+    regs = []
+    async for data, code in iter_pages(token, 'meetings/%d/registrants' % meeting_id):
+        regs.extend(map(zoom.clean_registrant, data['registrants']))
+    regs.sort(key=lambda r: r.sort_key)
+
+    return regs, code
+
+# Get the people who attended a past meeting, with their total minutes (see zoom_api.get_participants)
+async def get_participants(token, meeting_id):
+    records = []
+    async for data, code in iter_pages(token, 'report/meetings/%s/participants' % zoom.meeting_ref(meeting_id)):
+        records.extend(data['participants'])
+
+    # merging a big report takes a while, so don't hold up the event loop with it
+    people = await asyncio.get_running_loop().run_in_executor(None, zoom.summarize_participants, records)
+    return people, code